@@ -0,0 +1,468 @@
+"""
+批量处理
+
+读取、渲染、写入三个阶段组成流水线：读取线程预读文件，进程池把渲染分发到多个 CPU 核心，
+写入线程保存结果，每个文件的错误单独上报。
+支持暂停/取消，进度写入线程安全的 BatchProgress，由界面按固定频率读取。
+配合处理清单（watermark_manifest）可以跳过输出仍然有效的文件，中断后继续处理。
+超大 TIFF 不读入内存，由渲染阶段直接分块处理（watermark_tiled）；
+JPEG 在可能时只重新编码水印覆盖的区域（watermark_jpeg）。
+给定 BatchTimings 时记录每张图片各阶段的耗时（watermark_timing）。
+"""
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Event, Lock, Semaphore, Thread
+from typing import NamedTuple, Optional
+import os
+
+from watermark_engine import (
+    encode_watermarked_image,
+    process_file,
+    render_file,
+)
+from watermark_jpeg import process_jpeg_region
+from watermark_manifest import content_digest, file_digest
+from watermark_tiled import process_tiled_tiff, should_process_tiled
+from watermark_timing import ImageTiming, count, recording, stage
+
+# 子进程中的水印参数（由进程池初始化函数设置，避免每个任务重复传输）
+_worker_settings = None
+
+
+def default_workers():
+    """默认进程数：CPU 核心数"""
+    return os.cpu_count() or 1
+
+
+class BatchControl:
+    """批处理控制：暂停、继续、取消（可跨线程调用）"""
+
+    def __init__(self):
+        self._running = Event()
+        self._running.set()
+        self._cancelled = Event()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set()  # 唤醒等待中的批处理线程
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def wait_if_paused(self):
+        """暂停时阻塞，返回 False 表示已取消"""
+        self._running.wait()
+        return not self.cancelled
+
+
+class BatchProgress:
+    """线程安全的批处理进度，工作线程写入，界面定时读取"""
+
+    def __init__(self, total=0):
+        self._lock = Lock()
+        self.total = total
+        self.done = 0
+        self.errors = []      # [(输入路径, 错误信息)]
+        self.result = None    # 结束后的 BatchResult
+        self.finished = False
+
+    def update(self, done, total):
+        with self._lock:
+            self.done = done
+            self.total = total
+
+    def add_error(self, input_path, error):
+        with self._lock:
+            self.errors.append((input_path, error))
+
+    def finish(self, result=None):
+        with self._lock:
+            self.result = result
+            self.finished = True
+
+    def snapshot(self):
+        """返回 (完成数, 总数, 失败数, 是否结束)"""
+        with self._lock:
+            return self.done, self.total, len(self.errors), self.finished
+
+
+class BatchTask(NamedTuple):
+    """批处理任务"""
+    input_path: str
+    output_path: str
+    size: Optional[int] = None           # 输入文件大小（用于处理清单）
+    mtime_ns: Optional[int] = None       # 输入文件修改时间（用于处理清单）
+    expected_hash: Optional[str] = None  # 内容哈希与之相同时无需重新处理
+
+
+class TaskResult(NamedTuple):
+    """单个任务的处理结果"""
+    input_path: str
+    error: Optional[str]
+    digest: Optional[str]   # 输入文件内容哈希
+    skipped: bool           # 内容未变化，已跳过
+
+
+class BatchResult(NamedTuple):
+    """批处理结果统计"""
+    processed: int
+    skipped: int
+    errors: int
+    cancelled: bool
+
+
+def process_pool_context():
+    """
+    进程池的启动方式
+    线程运行时 fork 会把其他线程持有的锁（例如读取线程导入 Pillow 插件时的导入锁）复制到子进程，
+    子进程可能永远阻塞。有 forkserver 时从单线程的服务进程派生子进程（预先导入渲染模块），
+    否则使用 spawn（Windows 和 macOS 的默认方式）。
+    """
+    import multiprocessing
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["watermark_batch"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def _init_worker(settings):
+    """进程池初始化：保存水印参数"""
+    global _worker_settings
+    _worker_settings = settings
+
+
+def prepare_task(task, manifest=None):
+    """根据处理清单决定任务是否需要处理，返回 (任务, 是否跳过)"""
+    task = BatchTask(*task)
+    if manifest is None:
+        return task, False
+    size, mtime_ns = task.size, task.mtime_ns
+    if size is None or mtime_ns is None:
+        stat = os.stat(task.input_path)
+        size, mtime_ns = stat.st_size, stat.st_mtime_ns
+    state = manifest.check(task.output_path, size, mtime_ns)
+    if state is True:
+        return task, True
+    return task._replace(size=size, mtime_ns=mtime_ns, expected_hash=state), False
+
+
+def process_large_file(task, settings=None):
+    """分块处理超大 TIFF，文件结构不支持时改为整图处理；直接写入输出文件"""
+    settings = settings or _worker_settings
+    if not process_tiled_tiff(task.input_path, task.output_path, settings):
+        process_file(task.input_path, task.output_path, settings)
+
+
+def process_task(task, settings=None):
+    """处理单个任务：读取文件并计算内容哈希，内容未变化时跳过"""
+    task = BatchTask(*task)
+    try:
+        if should_process_tiled(task.input_path):
+            with stage("read"):
+                digest = file_digest(task.input_path)
+            if task.expected_hash and digest == task.expected_hash:
+                return TaskResult(task.input_path, None, digest, True)
+            process_large_file(task, settings)
+            return TaskResult(task.input_path, None, digest, False)
+        with stage("read"):
+            with open(task.input_path, "rb") as f:
+                data = f.read()
+            digest = content_digest(data)
+        count(bytes_read=len(data))
+        if task.expected_hash and digest == task.expected_hash:
+            return TaskResult(task.input_path, None, digest, True)
+        settings = settings or _worker_settings
+        if not process_jpeg_region(task.input_path, task.output_path, settings, data):
+            process_file(task.input_path, task.output_path, settings, data)
+        return TaskResult(task.input_path, None, digest, False)
+    except Exception as e:
+        return TaskResult(task.input_path, str(e), None, False)
+
+
+def render_task(task, data, settings=None, encode=True):
+    """
+    渲染阶段：添加水印，返回 (渲染结果, 各阶段耗时 ImageTiming)
+    在子进程中 encode 为 True，编码为输出文件的字节后只把编码结果传回主进程；
+    单进程时返回水印图片，由写入线程编码。data 为 None 时分块处理超大 TIFF，
+    JPEG 可以局部重新编码时也直接写入输出文件，这两种情况渲染结果为 None
+    """
+    settings = settings or _worker_settings
+    record = ImageTiming(task.input_path)
+    with recording(record):
+        if data is None:
+            process_large_file(task, settings)
+            return None, record
+        if process_jpeg_region(task.input_path, task.output_path, settings, data):
+            return None, record
+        rendered = render_file(task.input_path, settings, data)
+        if encode:
+            rendered = encode_watermarked_image(rendered, task.output_path, settings)
+    return rendered, record
+
+
+def write_output(output_path, rendered, settings=None):
+    """
+    写入阶段：rendered 为编码后的字节或尚未编码的水印图片（按 settings 的编码预设保存），
+    为 None 时表示渲染阶段已经写入了输出文件
+    """
+    if rendered is None:
+        return
+    if not isinstance(rendered, bytes):
+        rendered = encode_watermarked_image(rendered, output_path, settings)
+    with stage("write"):
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with open(output_path, "wb") as f:
+            f.write(rendered)
+    count(bytes_written=len(rendered))
+
+
+class BatchPipeline:
+    """
+    分阶段批处理流水线
+    读取线程预读文件 -> 渲染（多进程，或单个线程）-> 写入线程编码并保存，
+    磁盘读写和水印合成相互重叠。同时读入或渲染中的文件数受 max_in_flight 限制，
+    内存占用有上限。每个任务的结果 (任务, TaskResult, ImageTiming) 放入 results 队列，
+    全部结束后放入 DONE。
+    """
+
+    DONE = object()
+
+    def __init__(self, tasks, settings, workers, readers=2, writers=2, max_in_flight=None,
+                 control=None, manifest=None):
+        self.settings = settings
+        self.workers = workers
+        self.readers = readers
+        self.writers = writers
+        self.control = control or BatchControl()
+        self.manifest = manifest
+        self.results = Queue()
+        self._tasks = iter(tasks)
+        self._tasks_lock = Lock()
+        self._read_queue = Queue(maxsize=max(1, readers))
+        self._write_queue = Queue()
+        self._slots = Semaphore(max_in_flight or workers * 2 + writers)
+        self._lock = Lock()
+        self._readers_left = readers
+        self._writers_left = writers
+        self._executor = None
+
+    def start(self):
+        # 先创建进程池，再启动读取和写入线程
+        self._executor = self._create_executor()
+        for _ in range(self.readers):
+            Thread(target=self._read, daemon=True).start()
+        Thread(target=self._render, daemon=True).start()
+        for _ in range(self.writers):
+            Thread(target=self._write, daemon=True).start()
+
+    def _next_task(self):
+        with self._tasks_lock:
+            return next(self._tasks, None)
+
+    def _read(self):
+        """读取阶段：检查处理清单并读入文件内容，内容未变化的直接记为跳过"""
+        try:
+            while self.control.wait_if_paused():
+                task = self._next_task()
+                if task is None:
+                    break
+                self._slots.acquire()
+                record = ImageTiming(BatchTask(*task).input_path)
+                try:
+                    task, skip = prepare_task(task, self.manifest)
+                    if skip:
+                        self._release(task, TaskResult(task.input_path, None, None, True))
+                        continue
+                    with recording(record), stage("read"):
+                        if should_process_tiled(task.input_path):
+                            # 超大 TIFF 只计算哈希，不读入内存
+                            data = None
+                            digest = file_digest(task.input_path)
+                        else:
+                            with open(task.input_path, "rb") as f:
+                                data = f.read()
+                            digest = content_digest(data)
+                            count(bytes_read=len(data))
+                    if task.expected_hash and digest == task.expected_hash:
+                        self._release(task, TaskResult(task.input_path, None, digest, True))
+                        continue
+                except Exception as e:
+                    task = BatchTask(*task)
+                    self._release(task, TaskResult(task.input_path, str(e), None, False))
+                    continue
+                self._read_queue.put((task, data, digest, record))
+        finally:
+            with self._lock:
+                self._readers_left -= 1
+                last = self._readers_left == 0
+            if last:
+                self._read_queue.put(self.DONE)
+
+    def _create_executor(self):
+        """渲染用的进程池（单进程时为一个渲染线程）"""
+        if self.workers > 1:
+            # 进程池模块较大，只在需要时导入，缩短命令行的启动时间
+            from concurrent.futures import ProcessPoolExecutor
+            return ProcessPoolExecutor(max_workers=self.workers,
+                                       mp_context=process_pool_context(),
+                                       initializer=_init_worker,
+                                       initargs=(self.settings,))
+        return ThreadPoolExecutor(max_workers=1)
+
+    def _render(self):
+        """渲染阶段：把读入的文件提交给进程池（或单个渲染线程）"""
+        executor = self._executor
+        pending = set()
+        try:
+            while True:
+                item = self._read_queue.get()
+                if item is self.DONE:
+                    break
+                task, data, digest, record = item
+                if self.control.cancelled:
+                    # 取消后丢弃已读入但尚未渲染的文件
+                    self._slots.release()
+                    continue
+                try:
+                    if self.workers > 1:
+                        future = executor.submit(render_task, task, data)
+                    else:
+                        future = executor.submit(render_task, task, data, self.settings, False)
+                except Exception as e:
+                    self._release(task, TaskResult(task.input_path, str(e), None, False))
+                    continue
+                pending.add(future)
+                future.add_done_callback(pending.discard)
+                future.add_done_callback(
+                    lambda f, task=task, digest=digest, record=record:
+                    self._write_queue.put((task, digest, record, f)))
+
+            if self.control.cancelled:
+                for future in list(pending):
+                    future.cancel()
+        finally:
+            executor.shutdown(wait=True)
+            for _ in range(self.writers):
+                self._write_queue.put(self.DONE)
+
+    def _write(self):
+        """写入阶段：编码（单进程时）并保存水印图片"""
+        try:
+            while True:
+                item = self._write_queue.get()
+                if item is self.DONE:
+                    break
+                task, digest, record, future = item
+                if future.cancelled():
+                    self._slots.release()
+                    continue
+                try:
+                    rendered, render_record = future.result()
+                    record.merge(render_record)
+                    with recording(record):
+                        write_output(task.output_path, rendered, self.settings)
+                    result = TaskResult(task.input_path, None, digest, False)
+                except Exception as e:
+                    result = TaskResult(task.input_path, str(e), None, False)
+                self._release(task, result, record)
+        finally:
+            with self._lock:
+                self._writers_left -= 1
+                last = self._writers_left == 0
+            if last:
+                self.results.put(self.DONE)
+
+    def _release(self, task, result, record=None):
+        """任务结束：上报结果（和各阶段耗时）并释放名额"""
+        self.results.put((task, result, record))
+        self._slots.release()
+
+
+def run_batch(tasks, settings, workers=None, on_progress=None, on_error=None, control=None,
+              manifest=None, readers=2, writers=2, timings=None):
+    """
+    批量处理图片
+    tasks 为 BatchTask 或 (输入路径, 输出路径) 列表；on_progress(完成数, 总数, 输入路径)
+    和 on_error(输入路径, 错误信息) 在调用线程中回调。control 为 BatchControl，
+    暂停时不再读取新文件，取消时丢弃尚未开始的任务。给定 manifest（BatchManifest）时
+    跳过输出仍然有效的文件，并记录处理完成的文件。workers、readers、writers 分别为
+    渲染进程数、读取线程数和写入线程数（见 BatchPipeline）。给定 timings（BatchTimings）时
+    汇总每张图片各阶段的耗时。返回 BatchResult。
+    """
+    control = control or BatchControl()
+    tasks = list(tasks)
+    total = len(tasks)
+    workers = max(1, int(workers or default_workers()))
+    done = 0
+    errors = 0
+    skipped = 0
+
+    def finish(task, result, record=None):
+        nonlocal done, errors, skipped
+        done += 1
+        if result.error is not None:
+            errors += 1
+            if timings is not None:
+                timings.add_error()
+            if on_error:
+                on_error(result.input_path, result.error)
+        else:
+            if result.skipped:
+                skipped += 1
+            if timings is not None:
+                if result.skipped:
+                    timings.add_skipped()
+                elif record is not None:
+                    timings.add(record)
+            if manifest is not None and result.digest is not None:
+                manifest.record(task.output_path, task.size, task.mtime_ns, result.digest)
+        if on_progress:
+            on_progress(done, total, result.input_path)
+
+    try:
+        # 单个文件：直接在当前线程处理，不启动流水线
+        if total <= 1:
+            for task in tasks:
+                if not control.wait_if_paused():
+                    break
+                task = BatchTask(*task)
+                record = ImageTiming(task.input_path)
+                try:
+                    task, skip = prepare_task(task, manifest)
+                    if skip:
+                        result = TaskResult(task.input_path, None, None, True)
+                    else:
+                        with recording(record):
+                            result = process_task(task, settings)
+                except Exception as e:
+                    result = TaskResult(task.input_path, str(e), None, False)
+                finish(task, result, record)
+            return BatchResult(done - errors - skipped, skipped, errors, control.cancelled)
+
+        pipeline = BatchPipeline(tasks, settings, workers, max(1, int(readers)), max(1, int(writers)),
+                                 control=control, manifest=manifest)
+        pipeline.start()
+        while True:
+            item = pipeline.results.get()
+            if item is pipeline.DONE:
+                break
+            finish(*item)
+
+        return BatchResult(done - errors - skipped, skipped, errors, control.cancelled)
+    finally:
+        if timings is not None:
+            timings.finish()
+        if manifest is not None:
+            manifest.compact()
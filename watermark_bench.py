@@ -0,0 +1,418 @@
+"""
+性能基准测试
+
+生成一组固定内容的合成图片（不同尺寸、格式和颜色模式），分别计时水印处理的各个热点：
+文字水印、图片水印、背景颜色分析、水印尺寸计算、预览渲染（代理图 + 金字塔取可见区域，
+与界面 update_preview 的流程相同）以及端到端批处理（与界面 process_images 相同的 run_batch）。
+结果包含吞吐量（张/秒）、耗时分位数和内存峰值（每项基准在单独的子进程中运行，
+峰值只反映该项基准本身），保存为 JSON；--compare 与保存的基线比较，
+变慢超过阈值时标记为回退并返回非零退出码：
+
+    python watermark_bench.py -o baseline.json
+    python watermark_bench.py -o current.json --compare baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, features
+
+from watermark_batch import BatchTask, process_pool_context, run_batch
+from watermark_engine import (
+    WatermarkSettings,
+    add_image_watermark,
+    add_text_watermark,
+    analyze_background,
+    _composite_stamp,
+    calculate_watermark_size,
+    plan_watermark,
+    stamp_cache,
+)
+from watermark_preview import PreviewProxyCache, PreviewPyramid, create_preview_image
+from watermark_timing import percentile
+
+# 合成图片：(宽, 高, 格式扩展名, 颜色模式)
+CORPUS_SPECS = (
+    (640, 480, ".jpg", "RGB"),
+    (640, 480, ".png", "RGBA"),
+    (640, 480, ".png", "P"),
+    (1920, 1080, ".jpg", "RGB"),
+    (1920, 1080, ".jpg", "L"),
+    (1920, 1080, ".png", "RGBA"),
+    (1920, 1080, ".webp", "RGB"),
+    (1920, 1080, ".tiff", "I;16"),
+    (1920, 1080, ".tiff", "I"),
+    (1920, 1080, ".bmp", "RGB"),
+    (4000, 3000, ".jpg", "RGB"),
+    (4000, 3000, ".tiff", "RGB"),
+)
+
+# --quick 时只使用不超过该像素数的图片
+QUICK_MAX_PIXELS = 2_100_000
+
+# 与基线比较的指标：(指标, 数值越大越好)
+COMPARE_METRICS = (("p50_ms", False), ("p90_ms", False), ("images_per_sec", True))
+
+# 合成基准使用的图片模式（NumPy 实现支持的模式）
+COMPOSITE_MODES = ("RGB", "RGBA", "L", "I;16", "I")
+
+# 合成结果检查：任一项不为 0 时 main 返回 1
+CHECK_METRICS = ("mismatched_pixels", "high_bit_depth_errors")
+
+# 预览画布尺寸
+PREVIEW_CANVAS = 900
+
+# 各项基准（按运行顺序）
+BENCHMARKS = (
+    "add_text_watermark", "add_image_watermark", "analyze_background", "calculate_watermark_size",
+    "composite_pillow", "composite_numpy", "update_preview", "process_images",
+)
+
+
+def _synthetic_image(width, height, mode):
+    """生成固定内容的测试图片：渐变背景加上分形纹理和色块，背景明暗各处不同"""
+    texture = Image.effect_mandelbrot((256, 256), (-2.0, -1.2, 0.8, 1.2), 64)
+    red = Image.linear_gradient("L").resize((width, height))
+    green = texture.resize((width, height), Image.Resampling.BILINEAR)
+    blue = Image.radial_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (red, green, blue))
+    draw = ImageDraw.Draw(image)
+    step = max(width, height) // 8
+    for i in range(0, width, step):
+        draw.rectangle((i, height // 3, i + step // 2, height // 2), fill=(255 - i * 255 // width, 40, 200))
+
+    if mode == "RGBA":
+        image.putalpha(Image.linear_gradient("L").rotate(90).resize((width, height)).point(lambda v: 128 + v // 2))
+        return image
+    if mode == "P":
+        return image.quantize(256)
+    if mode == "I;16":
+        return image.convert("L").point(lambda v: v * 257, "I").convert("I;16")
+    if mode == "I":
+        # 32 位有符号整数，大部分数值超出 16 位范围，并含有负值
+        return image.convert("L").point(lambda v: v * 2 ** 23 - 2 ** 30, "I")
+    return image.convert(mode)
+
+
+def make_corpus(folder, specs=CORPUS_SPECS):
+    """在 folder 中生成测试图片（已存在时不重复生成），返回图片路径列表"""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for width, height, extension, mode in specs:
+        name = f"{width}x{height}_{mode.replace(';', '')}{extension}"
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            _synthetic_image(width, height, mode).save(path)
+        paths.append(path)
+
+    # 图片水印使用的半透明标志
+    logo_path = os.path.join(folder, "logo.png")
+    if not os.path.exists(logo_path):
+        logo = Image.new("RGBA", (400, 200), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(logo)
+        draw.ellipse((10, 10, 190, 190), fill=(220, 30, 30, 230))
+        draw.rectangle((210, 40, 390, 160), fill=(30, 30, 220, 180))
+        logo.save(logo_path)
+    return paths, logo_path
+
+
+def peak_rss_mb(children=False):
+    """进程（或已结束的子进程）的内存峰值（MB），平台不支持时返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # macOS 以字节为单位，Linux 以 KB 为单位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(samples, images=None):
+    """
+    把每次调用的耗时（秒）汇总为统计结果
+    images 为处理的图片数（默认每次调用一张），用于计算吞吐量
+    """
+    ordered = sorted(samples)
+    total = sum(ordered)
+    images = len(ordered) if images is None else images
+    return {
+        "count": len(ordered),
+        "images_per_sec": images / total if total else 0.0,
+        "mean_ms": total / len(ordered) * 1000,
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": percentile(ordered, 0.5) * 1000,
+        "p90_ms": percentile(ordered, 0.9) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000,
+        "max_ms": ordered[-1] * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _time_calls(images, call, repeat, inner=1):
+    """对每张图片调用 call(图片) repeat 次（首次为预热，不计时），返回每次调用的耗时"""
+    samples = []
+    for image in images:
+        call(image)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(inner):
+                call(image)
+            samples.append((time.perf_counter() - start) / inner)
+    return samples
+
+
+def run_benchmarks(paths, logo_path, font_path=None, repeat=5, workers=None, only=None):
+    """
+    运行各项基准测试，返回 {名称: 统计结果}
+    ru_maxrss 是整个进程的历史峰值，因此每项基准在新的子进程中运行，内存峰值互不累积
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    results = {}
+    for name in BENCHMARKS:
+        if only and name not in only:
+            continue
+        with ProcessPoolExecutor(max_workers=1, mp_context=process_pool_context()) as executor:
+            results[name] = executor.submit(
+                run_benchmark, name, paths, logo_path, font_path, repeat, workers).result()
+    return results
+
+
+def run_benchmark(name, paths, logo_path, font_path=None, repeat=5, workers=None):
+    """在当前进程中运行一项基准测试，返回统计结果"""
+    text_settings = WatermarkSettings(text="基准测试 Benchmark\n© 2024", font_path=font_path,
+                                      angle=30, position="bottom_right")
+    image_settings = WatermarkSettings(watermark_type="image", watermark_image_path=logo_path,
+                                       alpha=0.6, angle=15, position="center")
+
+    def load_images():
+        # 只在需要时解码测试图片，不计入其他基准的内存峰值
+        images = []
+        for path in paths:
+            with Image.open(path) as image:
+                image.load()
+                images.append(image)
+        return images
+
+    benchmarks = {
+        # 每次在原图副本上合成，复制本身也计入耗时（与批处理中每张图片只合成一次相同）
+        "add_text_watermark": lambda: _time_calls(
+            load_images(), lambda image: add_text_watermark(image.copy(), text_settings), repeat),
+        "add_image_watermark": lambda: _time_calls(
+            load_images(), lambda image: add_image_watermark(image.copy(), image_settings), repeat),
+        "analyze_background": lambda: _time_calls(load_images(), analyze_background, repeat),
+        "calculate_watermark_size": lambda: _time_calls(
+            load_images(), lambda image: calculate_watermark_size(image.size, text_settings), repeat, 1000),
+        # 只计时合成本身：Pillow（渲染引擎使用）与 NumPy 整数实现，并检查两者逐位一致
+        "composite_pillow": lambda: _bench_composite(load_images(), image_settings, repeat, False),
+        "composite_numpy": lambda: _bench_composite(load_images(), image_settings, repeat, True),
+        "update_preview": lambda: _bench_preview(paths, text_settings, repeat),
+        "process_images": lambda: _bench_batch(paths, text_settings, repeat, workers),
+    }
+
+    stamp_cache.clear()
+    outcome = benchmarks[name]()
+    return outcome if isinstance(outcome, dict) else summarize(outcome)
+
+
+def _high_bit_depth_errors(original, result, stamp_image, position):
+    """
+    16 位、32 位整数图片的合成检查：与按浮点数计算的参考结果相差超过 1 的像素数
+    图章完全透明处应保持原值，超出 16 位范围的数值不应被截断
+    """
+    import numpy as np
+
+    box = (position[0], position[1], position[0] + stamp_image.width, position[1] + stamp_image.height)
+    base = np.asarray(original.crop(box)).astype(np.float64)
+    alpha = np.asarray(stamp_image.getchannel('A')).astype(np.float64) / 255
+    gray = np.asarray(stamp_image.convert('L')).astype(np.float64) * 257
+    expected = np.where(alpha > 0, base * (1 - alpha) + gray * alpha, base)
+    actual = np.asarray(result.crop(box)).astype(np.float64)
+    return int(np.count_nonzero(np.abs(actual - expected) > 1))
+
+
+def _bench_composite(images, settings, repeat, use_numpy):
+    """
+    把同一个图章合成到每张图片（不含复制原图的耗时）
+    NumPy 实现额外统计与 Pillow 不一致的像素数；两种实现都检查高位深图片的混合结果
+    """
+    import numpy as np
+
+    from watermark_blend import composite
+
+    samples = []
+    mismatched = 0
+    high_bit_depth_errors = 0
+    for image in images:
+        stamp, position = plan_watermark(image.size, settings)
+        inside = (position[0] >= 0 and position[1] >= 0
+                  and position[0] + stamp.image.width <= image.width
+                  and position[1] + stamp.image.height <= image.height)
+        if image.mode not in COMPOSITE_MODES or not inside:
+            continue
+        expected = _composite_stamp(image.copy(), stamp, position)
+        for i in range(repeat + 1):
+            target = image.copy()
+            start = time.perf_counter()
+            if use_numpy:
+                composite(target, stamp.image, position)
+            else:
+                _composite_stamp(target, stamp, position)
+            if i:
+                # 首次为预热，不计时
+                samples.append(time.perf_counter() - start)
+        if image.mode in ("I;16", "I"):
+            high_bit_depth_errors += _high_bit_depth_errors(image, target, stamp.image, position)
+        if use_numpy:
+            different = np.asarray(target) != np.asarray(expected)
+            mismatched += int(np.count_nonzero(different.any(axis=2) if different.ndim == 3 else different))
+    stats = summarize(samples or [0.0])
+    stats["high_bit_depth_errors"] = high_bit_depth_errors
+    if use_numpy:
+        stats["mismatched_pixels"] = mismatched
+    return stats
+
+
+def _bench_preview(paths, settings, repeat):
+    """预览：在缓存的代理图上渲染水印，再从金字塔中取出画布大小的区域"""
+    cache = PreviewProxyCache()
+
+    def preview(path):
+        image = create_preview_image(cache, path, settings, PREVIEW_CANVAS)
+        scale = PREVIEW_CANVAS * 0.8 / max(image.size)
+        box = (0, 0, int(image.width * scale), int(image.height * scale))
+        PreviewPyramid(image).render(scale, box)
+
+    # 首次调用包含解码代理图，之后只在代理图上重新渲染（拖动滑块时的情况）
+    return _time_calls(paths, preview, repeat)
+
+
+def _bench_batch(paths, settings, repeat, workers):
+    """端到端批处理：读取、添加水印、编码并写入临时文件夹"""
+    output = tempfile.mkdtemp(prefix="watermark_bench_")
+    samples = []
+    try:
+        tasks = [BatchTask(path, os.path.join(output, os.path.basename(path))) for path in paths]
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = run_batch(tasks, settings, workers)
+            samples.append(time.perf_counter() - start)
+            if result.errors:
+                raise RuntimeError(f"批处理中有 {result.errors} 张图片失败")
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+    stats = summarize(samples, len(paths) * repeat)
+    stats["files"] = len(paths)
+    stats["peak_rss_children_mb"] = peak_rss_mb(children=True)
+    return stats
+
+
+def environment():
+    """记录运行环境，便于判断两次结果是否可比"""
+    import PIL
+
+    return {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "libjpeg_turbo": bool(features.check_feature("libjpeg_turbo")),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    与基线比较，返回 [(基准名称, 指标, 基线值, 当前值, 变化比例, 是否回退)]
+    变化比例为正表示变慢；变慢超过 threshold 时记为回退
+    """
+    rows = []
+    for name, stats in current["benchmarks"].items():
+        base = baseline.get("benchmarks", {}).get(name)
+        if not base:
+            continue
+        for metric, higher_is_better in COMPARE_METRICS:
+            old, new = base.get(metric), stats.get(metric)
+            if not old or new is None:
+                continue
+            change = (old - new) / old if higher_is_better else (new - old) / old
+            rows.append((name, metric, old, new, change, change > threshold))
+    return rows
+
+
+def print_results(results):
+    print(f"{'基准':<26}{'张/秒':>10}{'p50(ms)':>10}{'p90(ms)':>10}{'p99(ms)':>10}{'峰值内存(MB)':>14}")
+    for name, stats in results.items():
+        rss = stats["peak_rss_mb"]
+        print(f"{name:<26}{stats['images_per_sec']:>10.1f}{stats['p50_ms']:>10.2f}"
+              f"{stats['p90_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+              f"{(f'{rss:.0f}' if rss is not None else '-'):>14}")
+
+
+def check_failures(results):
+    """合成结果检查中不为 0 的项：[(基准, 指标, 像素数), ...]"""
+    return [(name, metric, stats[metric])
+            for name, stats in results.items() for metric in CHECK_METRICS if stats.get(metric)]
+
+
+def print_comparison(rows, threshold):
+    print(f"\n与基线比较（变慢超过 {threshold:.0%} 记为回退）：")
+    for name, metric, old, new, change, regressed in rows:
+        flag = "回退" if regressed else ""
+        print(f"{name:<26}{metric:<16}{old:>10.2f} -> {new:<10.2f}{change:>+8.1%}  {flag}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="水印处理性能基准测试")
+    parser.add_argument("--corpus", help="测试图片文件夹（默认使用临时文件夹，已有图片时直接复用）")
+    parser.add_argument("-o", "--output", help="保存结果的 JSON 文件")
+    parser.add_argument("--compare", metavar="BASELINE", help="与保存的基线 JSON 比较")
+    parser.add_argument("--threshold", type=float, default=0.1, help="回退阈值（默认 0.1，即变慢 10%%）")
+    parser.add_argument("--repeat", type=int, default=5, help="每张图片的计时次数（默认 5）")
+    parser.add_argument("-j", "--workers", type=int, help="端到端批处理的渲染进程数（默认 CPU 核心数）")
+    parser.add_argument("--font", help="文字水印使用的字体文件（默认自动查找中文字体）")
+    parser.add_argument("--only", action="append", help="只运行指定的基准，可重复")
+    parser.add_argument("--quick", action="store_true", help="只使用较小的图片，快速检查")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    specs = CORPUS_SPECS
+    if args.quick:
+        specs = [spec for spec in specs if spec[0] * spec[1] <= QUICK_MAX_PIXELS]
+    corpus = args.corpus or os.path.join(tempfile.gettempdir(), "watermark_bench_corpus")
+    paths, logo_path = make_corpus(corpus, specs)
+
+    results = run_benchmarks(paths, logo_path, args.font, max(1, args.repeat), args.workers, args.only)
+    report = {"environment": environment(), "corpus": [os.path.basename(path) for path in paths],
+              "benchmarks": results}
+    print_results(results)
+    failures = check_failures(results)
+    for name, metric, pixels in failures:
+        print(f"合成结果错误：{name} {metric} = {pixels}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare(baseline, report, args.threshold)
+        print_comparison(rows, args.threshold)
+        if any(row[-1] for row in rows):
+            return 1
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    from multiprocessing import freeze_support
+    freeze_support()
+    sys.exit(main())
@@ -0,0 +1,309 @@
+"""
+命令行批量添加水印（无界面）
+
+不导入任何界面模块，也不需要显示器，适合定时任务和容器中调用。
+参数可以来自任务文件（JSON）或命令行，命令行参数优先：
+
+    python watermark_cli.py -i 输入文件夹 -o 输出文件夹 --text "水印文字" --position bottom_right
+    python watermark_cli.py --job job.json --alpha 0.5
+
+任务文件中的键与命令行参数同名，例如 {"input": "...", "output": "...", "text": "...", "size": 0.08}。
+"""
+import time
+
+_START = time.perf_counter()
+
+import argparse
+import json
+import os
+import sys
+
+# 与界面一致的九宫格位置和平铺（这里不导入渲染引擎，保持 --help 和参数错误时的启动速度）
+POSITION_CHOICES = (
+    "top_left", "top_center", "top_right",
+    "middle_left", "center", "middle_right",
+    "bottom_left", "bottom_center", "bottom_right",
+    "tile",
+)
+
+# 任务文件中允许的键 -> 默认值
+JOB_DEFAULTS = {
+    "input": None,
+    "output": None,
+    "text": None,
+    "image": None,
+    "font": None,
+    "size": 0.1,
+    "alpha": 0.7,
+    "angle": 0.0,
+    "position": "center",
+    "tile_spacing": 0.5,
+    "tile_offset": (0.0, 0.0),
+    "tile_stagger": 0.5,
+    "color": None,
+    "recursive": False,
+    "workers": None,
+    "readers": 2,
+    "writers": 2,
+    "incremental": True,
+    "preset": "balanced",
+    "encoder_options": [],
+    "metadata": True,
+}
+
+
+def parse_color(value):
+    """解析颜色：#RRGGBB 或 R,G,B"""
+    if isinstance(value, (list, tuple)):
+        parts = list(value)
+    elif value.startswith("#") and len(value) == 7:
+        parts = [int(value[i:i + 2], 16) for i in (1, 3, 5)]
+    else:
+        parts = [int(part) for part in value.split(",")]
+    if len(parts) != 3 or not all(0 <= int(part) <= 255 for part in parts):
+        raise ValueError(f"无效的颜色：{value}")
+    return tuple(int(part) for part in parts)
+
+
+def parse_offset(value):
+    """解析平铺偏移：X,Y 或 [X, Y]"""
+    parts = list(value) if isinstance(value, (list, tuple)) else value.split(",")
+    try:
+        if len(parts) != 2:
+            raise ValueError
+        return tuple(float(part) for part in parts)
+    except (TypeError, ValueError):
+        raise ValueError(f"无效的平铺偏移：{value}（格式为 X,Y）")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="批量为图片添加文字或图片水印（命令行版）")
+    parser.add_argument("--job", help="任务文件（JSON），命令行参数会覆盖其中的同名设置")
+    parser.add_argument("-i", "--input", help="输入文件夹或单张图片")
+    parser.add_argument("-o", "--output", help="输出文件夹（输入为单张图片时也可以是输出文件路径）")
+    parser.add_argument("--text", help="文字水印内容，\\n 表示换行")
+    parser.add_argument("--image", help="图片水印文件")
+    parser.add_argument("--font", help="字体文件（默认自动查找中文字体）")
+    parser.add_argument("--size", type=float, help="水印大小比例 0.01~0.5（默认 0.1）")
+    parser.add_argument("--alpha", type=float, help="不透明度 0~1（默认 0.7）")
+    parser.add_argument("--angle", type=float, help="旋转角度（默认 0）")
+    parser.add_argument("--position", choices=POSITION_CHOICES,
+                        help="水印位置（默认 center），tile 为重复铺满整张图片")
+    parser.add_argument("--tile-spacing", type=float, help="平铺时水印之间的间隙，相对水印大小（默认 0.5）")
+    parser.add_argument("--tile-offset", help="平铺网格的偏移 X,Y，相对网格间距（默认 0,0）")
+    parser.add_argument("--tile-stagger", type=float, help="平铺时隔行错开的比例 0~1（默认 0.5）")
+    parser.add_argument("--color", help="水印颜色 #RRGGBB 或 R,G,B（默认智能颜色）")
+    parser.add_argument("-r", "--recursive", action="store_true", default=None, help="包含子文件夹")
+    parser.add_argument("-j", "--workers", type=int, help="并行渲染进程数（默认 CPU 核心数）")
+    parser.add_argument("--readers", type=int, help="预读文件的线程数（默认 2，网络存储可适当增加）")
+    parser.add_argument("--writers", type=int, help="编码和写入文件的线程数（默认 2）")
+    parser.add_argument("--no-incremental", dest="incremental", action="store_false", default=None,
+                        help="不跳过未变化的图片，全部重新处理")
+    parser.add_argument("--preset", help="输出编码预设：balanced（默认）、fast、small、lossless")
+    parser.add_argument("--encoder-option", dest="encoder_options", action="append",
+                        help="覆盖编码参数，格式为 格式.参数=值，例如 JPEG.quality=90，可重复")
+    parser.add_argument("--no-metadata", dest="metadata", action="store_false", default=None,
+                        help="不保留原图的 EXIF、ICC 配置和 DPI")
+    parser.add_argument("--encoder-report", type=int, metavar="N",
+                        help="用输入中的前 N 张图片比较各编码预设的耗时和文件大小，不写入输出")
+    parser.add_argument("--watch", action="store_true", help="持续监视输入文件夹，按 Ctrl+C 停止")
+    parser.add_argument("-q", "--quiet", action="store_true", help="只输出错误")
+    parser.add_argument("--timing", action="store_true", help="输出启动和处理耗时")
+    return parser
+
+
+def load_job(args):
+    """合并任务文件和命令行参数"""
+    job = dict(JOB_DEFAULTS)
+    if args.job:
+        with open(args.job, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        unknown = set(data) - set(JOB_DEFAULTS)
+        if unknown:
+            raise ValueError(f"任务文件包含未知的设置：{', '.join(sorted(unknown))}")
+        job.update(data)
+    for key in JOB_DEFAULTS:
+        value = getattr(args, key, None)
+        if value is not None:
+            job[key] = value
+
+    if not job["input"] or not job["output"]:
+        raise ValueError("请指定输入（--input）和输出（--output）")
+    if bool(job["text"]) == bool(job["image"]):
+        raise ValueError("请指定文字水印（--text）或图片水印（--image）其中之一")
+    if job["position"] not in POSITION_CHOICES:
+        raise ValueError(f"无效的位置：{job['position']}")
+    if job["text"] and args.text is not None:
+        job["text"] = job["text"].replace("\\n", "\n")
+    if job["color"] is not None:
+        job["color"] = parse_color(job["color"])
+    job["tile_offset"] = parse_offset(job["tile_offset"])
+    if not isinstance(job["encoder_options"], (list, tuple)):
+        raise ValueError("encoder_options 应为列表，例如 [\"JPEG.quality=90\"]")
+
+    from watermark_encoders import ENCODER_PRESETS, parse_encoder_option
+    if job["preset"] not in ENCODER_PRESETS:
+        raise ValueError(f"未知的编码预设：{job['preset']}")
+    job["encoder_options"] = tuple(parse_encoder_option(option) for option in job["encoder_options"])
+    return job
+
+
+def make_settings(job):
+    """根据任务生成水印参数快照"""
+    from watermark_engine import WatermarkSettings
+
+    return WatermarkSettings(
+        watermark_type="image" if job["image"] else "text",
+        text=job["text"] or "",
+        font_path=job["font"],
+        size_ratio=float(job["size"]),
+        alpha=float(job["alpha"]),
+        angle=float(job["angle"]),
+        auto_color=job["color"] is None,
+        color=job["color"] or (0, 0, 0),
+        position=job["position"],
+        tile_spacing=float(job["tile_spacing"]),
+        tile_offset=job["tile_offset"],
+        tile_stagger=float(job["tile_stagger"]),
+        watermark_image_path=job["image"],
+        encoder_preset=job["preset"],
+        encoder_overrides=job["encoder_options"],
+        keep_metadata=bool(job["metadata"])
+    )
+
+
+def collect_tasks(job):
+    """生成批处理任务，返回 (任务列表, 输出文件夹)"""
+    from watermark_batch import BatchTask
+    from watermark_index import FolderIndex
+
+    source = job["input"]
+    if os.path.isfile(source):
+        output = job["output"]
+        if os.path.isdir(output) or output.endswith(("/", os.sep)):
+            output = os.path.join(output, os.path.basename(source))
+        stat = os.stat(source)
+        return [BatchTask(source, output, stat.st_size, stat.st_mtime_ns)], os.path.dirname(output) or "."
+
+    index = FolderIndex(source, recursive=bool(job["recursive"]), exclude=[job["output"]])
+    tasks = [BatchTask(index.path(entry), index.output_path(entry, job["output"]),
+                       entry.size, entry.mtime_ns)
+             for entry in index]
+    return tasks, job["output"]
+
+
+def run_job(job, quiet=False):
+    """执行批处理，返回失败的文件数"""
+    from watermark_batch import run_batch
+    from watermark_manifest import BatchManifest, settings_fingerprint
+    from watermark_timing import BatchTimings, format_rate
+
+    settings = make_settings(job)
+    tasks, output_folder = collect_tasks(job)
+    if not tasks:
+        print("输入中没有支持的图片文件", file=sys.stderr)
+        return 0
+
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = None
+    if job["incremental"]:
+        manifest = BatchManifest(output_folder, settings_fingerprint(settings))
+
+    timings = BatchTimings()
+
+    def on_progress(done, total, input_path):
+        if not quiet:
+            rate = format_rate(timings, done, total)
+            print(f"[{done}/{total}] {input_path}" + (f"  {rate}" if rate else ""))
+
+    def on_error(input_path, error):
+        print(f"处理文件 {input_path} 时出错: {error}", file=sys.stderr)
+
+    result = run_batch(tasks, settings, job["workers"], on_progress=on_progress,
+                       on_error=on_error, manifest=manifest,
+                       readers=job["readers"], writers=job["writers"], timings=timings)
+    report_path = timings.save(output_folder)
+    if not quiet:
+        print(f"完成：处理 {result.processed} 张，跳过 {result.skipped} 张，失败 {result.errors} 张，"
+              f"耗时 {timings.elapsed:.1f} 秒")
+        print(f"各阶段耗时报告：{report_path}")
+    return result.errors
+
+
+def report_encoders(job, count):
+    """对前 count 张图片添加水印后，比较各编码预设的耗时和文件大小"""
+    from watermark_encoders import encoder_report
+    from watermark_engine import render_file
+
+    settings = make_settings(job)
+    tasks, _ = collect_tasks(job)
+    images = [(render_file(task.input_path, settings), task.output_path) for task in tasks[:count]]
+    if not images:
+        print("输入中没有支持的图片文件", file=sys.stderr)
+        return 0
+
+    print(f"{'预设':<10}{'格式':<6}{'数量':>6}{'平均耗时(ms)':>14}{'平均大小(KB)':>14}")
+    for row in encoder_report(images):
+        print(f"{row.preset:<10}{row.image_format:<6}{row.count:>6}"
+              f"{row.seconds / row.count * 1000:>14.1f}{row.bytes / row.count / 1024:>14.1f}")
+    return 0
+
+
+def watch_job(job, quiet=False):
+    """持续监视输入文件夹，直到按下 Ctrl+C"""
+    from watermark_watch import FolderWatcher
+
+    def on_event(event):
+        if event.error is None and not quiet:
+            state = "跳过" if event.skipped else f"{event.latency * 1000:.0f} ms"
+            print(f"{event.input_path} ({state})")
+
+    watcher = FolderWatcher(job["input"], job["output"], make_settings(job),
+                            recursive=bool(job["recursive"]), on_event=on_event)
+    watcher.start()
+    if not quiet:
+        print(f"正在监视 {job['input']}，按 Ctrl+C 停止")
+    try:
+        while watcher.running:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
+    return watcher.stats()[2]
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        job = load_job(args)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    # 参数检查通过后才加载渲染引擎
+    import watermark_batch  # noqa: F401
+    started = time.perf_counter()
+    if args.timing:
+        print(f"启动耗时：{(started - _START) * 1000:.1f} ms", file=sys.stderr)
+
+    if args.encoder_report:
+        errors = report_encoders(job, args.encoder_report)
+    elif args.watch:
+        try:
+            errors = watch_job(job, args.quiet)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        errors = run_job(job, args.quiet)
+
+    if args.timing:
+        print(f"处理耗时：{(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    # 打包为可执行文件时多进程需要
+    from multiprocessing import freeze_support
+    freeze_support()
+    sys.exit(main())
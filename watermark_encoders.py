@@ -0,0 +1,188 @@
+"""
+输出编码设置
+
+按输出格式选择编码参数（JPEG 质量/渐进/色度抽样、PNG 压缩级别、WebP 压缩方法/无损、
+TIFF 压缩方式），提供按速度和体积取舍的预设，并把原图的 EXIF、ICC 配置和 DPI
+直接从已读取的图片信息中带到输出文件，不需要再次解码。
+"""
+from typing import NamedTuple
+import io
+import os
+import time
+
+from PIL import Image
+
+# 编码预设：格式 -> Pillow 保存参数
+ENCODER_PRESETS = {
+    # 与之前的输出相同
+    "balanced": {
+        "JPEG": {"quality": 95},
+        "PNG": {},
+        "WEBP": {"quality": 95},
+        "TIFF": {},
+    },
+    # 编码最快
+    "fast": {
+        "JPEG": {"quality": 90, "subsampling": "4:2:0"},
+        "PNG": {"compress_level": 1},
+        "WEBP": {"quality": 90, "method": 0},
+        "TIFF": {},
+    },
+    # 文件最小
+    "small": {
+        "JPEG": {"quality": 85, "subsampling": "4:2:0", "optimize": True, "progressive": True},
+        "PNG": {"optimize": True},
+        "WEBP": {"quality": 85, "method": 6},
+        "TIFF": {"compression": "tiff_adobe_deflate"},
+    },
+    # 无损（JPEG 为最高质量）
+    "lossless": {
+        "JPEG": {"quality": 100, "subsampling": "4:4:4"},
+        "PNG": {"compress_level": 9},
+        "WEBP": {"lossless": True, "quality": 100},
+        "TIFF": {"compression": "tiff_lzw"},
+    },
+}
+
+# 界面中显示的预设名称
+ENCODER_PRESET_LABELS = {
+    "balanced": "均衡",
+    "fast": "最快",
+    "small": "最小体积",
+    "lossless": "无损",
+}
+
+DEFAULT_PRESET = "balanced"
+
+# 各格式支持带到输出文件的元数据
+METADATA_KEYS = {
+    "JPEG": ("exif", "icc_profile", "dpi"),
+    "PNG": ("exif", "icc_profile", "dpi"),
+    "WEBP": ("exif", "icc_profile"),
+    "TIFF": ("icc_profile", "dpi"),
+    "BMP": ("dpi",),
+}
+
+# 不保留元数据时仍需保留的图片信息（属于像素数据的一部分）
+PIXEL_INFO_KEYS = ("transparency",)
+
+# JPEG 可以直接保存的模式
+JPEG_MODES = ("RGB", "L", "CMYK")
+
+# EXIF 方向标签：水印是按存储方向添加的，输出时重置为正常方向，保持与添加水印前一致的显示效果
+EXIF_ORIENTATION = 0x0112
+
+
+def output_format(output_path):
+    """按扩展名确定输出格式"""
+    extension = os.path.splitext(output_path)[1].lower()
+    image_format = Image.registered_extensions().get(extension)
+    if image_format is None:
+        raise ValueError(f"不支持的输出格式：{extension}")
+    return image_format
+
+
+def image_for_format(image, image_format, keep_metadata=True):
+    """
+    JPEG 不支持的模式（透明通道、调色板等）转换为 RGB，其他情况保持原模式
+    keep_metadata 为 False 时返回不带原图信息的图片（共享像素数据）：Pillow 保存 PNG、TIFF 时
+    会从图片信息中补上 ICC 配置，保存打开的 TIFF 时还会复制 XMP、IPTC 和分辨率标签
+    """
+    if image_format == "JPEG" and image.mode not in JPEG_MODES:
+        image = image.convert("RGB")
+    if not keep_metadata:
+        info = {key: value for key, value in image.info.items() if key in PIXEL_INFO_KEYS}
+        image = image._new(image.im)
+        image.info = info
+    return image
+
+
+def parse_encoder_option(text):
+    """
+    解析单个编码参数覆盖，格式为 格式.参数=值，例如 JPEG.quality=90
+    值按 Python 字面量解析（数字、True/False），否则作为字符串
+    """
+    from ast import literal_eval
+
+    key, sep, value = text.partition("=")
+    image_format, dot, name = key.partition(".")
+    if not sep or not dot or not name:
+        raise ValueError(f"无效的编码参数：{text}（格式为 JPEG.quality=90）")
+    try:
+        value = literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return image_format.strip().upper(), name.strip(), value
+
+
+def _metadata(image, image_format):
+    """从原图信息中取出输出格式支持的元数据"""
+    options = {}
+    for key in METADATA_KEYS.get(image_format, ()):
+        value = image.info.get(key)
+        if not value:
+            continue
+        if key == "exif":
+            try:
+                exif = image.getexif()
+                if exif.get(EXIF_ORIENTATION, 1) != 1:
+                    exif[EXIF_ORIENTATION] = 1
+                    value = exif.tobytes()
+            except Exception as e:
+                # 无法解析时原样保留
+                print(f"解析 EXIF 时出错: {str(e)}")
+        elif key == "dpi":
+            value = tuple(round(float(v)) for v in value)
+        options[key] = value
+    return options
+
+
+def encoder_options(image, output_path, preset=DEFAULT_PRESET, overrides=(), keep_metadata=True):
+    """
+    返回 (格式, 保存参数)
+    overrides 为 (格式, 参数, 值) 序列，覆盖预设中的同名参数
+    """
+    image_format = output_format(output_path)
+    if preset not in ENCODER_PRESETS:
+        raise ValueError(f"未知的编码预设：{preset}")
+    options = {}
+    if keep_metadata:
+        options.update(_metadata(image, image_format))
+    options.update(ENCODER_PRESETS[preset].get(image_format, {}))
+    for override_format, name, value in overrides:
+        if override_format == image_format:
+            options[name] = value
+    return image_format, options
+
+
+class EncoderTiming(NamedTuple):
+    """编码预设的耗时统计"""
+    preset: str
+    image_format: str
+    count: int
+    seconds: float
+    bytes: int
+
+
+def encoder_report(images, presets=None, repeat=1):
+    """
+    用同一批已添加水印的图片比较各编码预设
+    images 为 (图片, 输出路径) 序列，只编码到内存不写入磁盘；返回 EncoderTiming 列表
+    """
+    images = list(images)
+    report = []
+    for preset in presets or ENCODER_PRESETS:
+        totals = {}
+        for image, output_path in images:
+            image_format, options = encoder_options(image, output_path, preset)
+            image = image_for_format(image, image_format)
+            for _ in range(repeat):
+                buffer = io.BytesIO()
+                start = time.perf_counter()
+                image.save(buffer, image_format, **options)
+                elapsed = time.perf_counter() - start
+                count, seconds, size = totals.get(image_format, (0, 0.0, 0))
+                totals[image_format] = (count + 1, seconds + elapsed, size + buffer.tell())
+        for image_format, (count, seconds, size) in sorted(totals.items()):
+            report.append(EncoderTiming(preset, image_format, count, seconds, size))
+    return report
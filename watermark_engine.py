@@ -0,0 +1,691 @@
+"""
+水印渲染引擎
+
+与界面无关的水印处理逻辑。所有参数通过不可变的 WatermarkSettings 快照传入，
+因此可以在工作线程、子进程或无显示器的环境中使用。
+"""
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from threading import Lock
+from typing import NamedTuple, Optional, Tuple
+import io
+import math
+import os
+
+from PIL import Image, ImageDraw, ImageFont, ImageStat
+
+from watermark_encoders import DEFAULT_PRESET, encoder_options, image_for_format
+from watermark_fonts import get_font
+from watermark_timing import count, stage
+
+# 支持的图片格式
+SUPPORTED_FORMATS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp')
+
+# 九宫格位置
+POSITIONS = (
+    "top_left", "top_center", "top_right",
+    "middle_left", "center", "middle_right",
+    "bottom_left", "bottom_center", "bottom_right",
+)
+
+# 平铺：同一个水印按网格重复铺满整张图片
+TILE_POSITION = "tile"
+
+
+@dataclass(frozen=True)
+class WatermarkSettings:
+    """水印参数快照（不可变、可序列化）"""
+    watermark_type: str = "text"            # "text" 或 "image"
+    text: str = ""                          # 水印文本，支持多行
+    font_path: Optional[str] = None         # 字体文件路径，None 时自动查找中文字体
+    size_ratio: float = 0.1                 # 水印大小比例
+    alpha: float = 0.7                      # 透明度 0~1
+    angle: float = 0.0                      # 旋转角度
+    auto_color: bool = True                 # 是否智能颜色
+    color: Tuple[int, int, int] = (0, 0, 0)  # 手动颜色 RGB
+    position: str = "center"                # 水印位置（九宫格之一或 TILE_POSITION）
+    watermark_image_path: Optional[str] = None  # 图片水印路径
+    encoder_preset: str = DEFAULT_PRESET    # 输出编码预设（见 watermark_encoders）
+    encoder_overrides: Tuple[Tuple[str, str, object], ...] = ()  # (格式, 参数, 值) 覆盖预设
+    keep_metadata: bool = True              # 保留原图的 EXIF、ICC 配置和 DPI
+    tile_spacing: float = 0.5               # 平铺时相邻水印的间隙（相对旋转后水印的宽高）
+    tile_offset: Tuple[float, float] = (0.0, 0.0)  # 平铺网格的偏移（相对网格间距）
+    tile_stagger: float = 0.5               # 平铺时隔行错开的距离（相对水平间距）
+
+    def with_changes(self, **changes):
+        """返回修改了部分字段的新快照"""
+        return replace(self, **changes)
+
+
+def calculate_watermark_size(image_size, settings):
+    """
+    计算水印的标准化尺寸
+    基于图片对角线长度计算，确保水印大小在视觉上保持一致
+    """
+    # 计算图片对角线长度
+    diagonal = math.sqrt(image_size[0]**2 + image_size[1]**2)
+    # 基于对角线长度计算基准字体大小
+    base_size = diagonal * settings.size_ratio
+    # 设置最小和最大限制
+    min_size = 24  # 最小字体大小
+    max_size = diagonal * 0.2  # 最大不超过对角线的20%
+    return int(max(min_size, min(base_size, max_size)))
+
+
+def calculate_position(base_size, watermark_size, position, margin=20):
+    """计算水印位置"""
+    x, y = 0, 0
+
+    # 水平位置
+    if "_left" in position:
+        x = margin  # 左边距
+    elif "_right" in position:
+        x = base_size[0] - watermark_size[0] - margin  # 右边距
+    else:  # center
+        x = (base_size[0] - watermark_size[0]) // 2
+
+    # 垂直位置
+    if position.startswith("top"):
+        y = margin  # 上边距
+    elif position.startswith("bottom"):
+        y = base_size[1] - watermark_size[1] - margin  # 下边距
+    else:  # center
+        y = (base_size[1] - watermark_size[1]) // 2
+
+    return x, y
+
+
+# 背景分析时每个区域缩小到的边长
+ANALYSIS_SAMPLE_SIZE = 64
+
+# 按 16 位灰度处理的模式（Pillow 的 paste 按字节混合，不能直接用于这些模式）
+HIGH_BIT_DEPTH_MODES = ("I;16", "I;16L", "I;16B", "I;16N", "I", "F")
+
+# 可以直接用图章的透明度作为蒙版贴入的模式（不含透明通道，图章自动转换为原图模式）
+PASTE_MODES = ("RGB", "RGBX", "L", "CMYK")
+
+
+def _background_regions(size):
+    """默认采样区域：四个角落和中心区域"""
+    width, height = size
+    dx, dy = max(1, width // 10), max(1, height // 10)
+    return [
+        (0, 0, dx, dy),                                   # 左上
+        (width - dx, 0, width, dy),                       # 右上
+        (0, height - dy, dx, height),                     # 左下
+        (width - dx, height - dy, width, height),         # 右下
+        (width // 3, height // 3,
+         max(width // 3 + 1, 2 * width // 3),
+         max(height // 3 + 1, 2 * height // 3))           # 中心区域
+    ]
+
+
+def region_mean(image, box):
+    """计算区域平均颜色：只复制该区域，并缩小后统计"""
+    region = image.crop(box)
+    if region.mode in HIGH_BIT_DEPTH_MODES and region.mode != "F":
+        # 16 位灰度缩放到 8 位再统计，直接转换会截断到 255
+        region = region.convert('I').point(lambda value: value / 257).convert('L')
+    elif region.mode in ('P', '1'):
+        # 调色板和二值图片不能直接缩小
+        region = region.convert('RGB')
+    factor = min(region.size) // ANALYSIS_SAMPLE_SIZE
+    if factor > 1:
+        region = region.reduce(factor)
+    if region.mode != 'RGB':
+        region = region.convert('RGB')
+    return ImageStat.Stat(region).mean
+
+
+def analyze_background(image, box=None):
+    """
+    分析图片背景颜色并返回合适的水印颜色
+    box 为水印覆盖的区域 (left, top, right, bottom)，给定时只分析该区域，
+    否则分析四个角落和中心区域
+    """
+    try:
+        # 采样区域（与图片求交集）
+        sample_regions = _background_regions(image.size)
+        if box is not None:
+            left, top = max(0, int(box[0])), max(0, int(box[1]))
+            right, bottom = min(image.width, int(box[2])), min(image.height, int(box[3]))
+            if left < right and top < bottom:
+                sample_regions = [(left, top, right, bottom)]
+
+        # 计算每个区域的平均颜色
+        region_colors = [region_mean(image, region) for region in sample_regions]
+
+        # 计算整体平均颜色
+        avg_color = [sum(channel) / len(region_colors) for channel in zip(*region_colors)]
+        return contrast_color(avg_color)
+
+    except Exception as e:
+        print(f"分析背景颜色时出错: {str(e)}")
+        # 出错时返回默认值：黑色水印
+        return (0, 0, 0), False
+
+
+def contrast_color(avg_color):
+    """根据背景平均颜色 (R, G, B) 选择对比明显的水印颜色，返回 (水印颜色, 是否深色背景)"""
+    # 计算亮度
+    brightness = sum(avg_color) / len(avg_color)
+
+    # 根据背景亮度选择水印颜色
+    if brightness < 128:
+        # 深色背景，使用浅色水印
+        watermark_color = (255, 255, 255)
+        is_dark = True
+    else:
+        # 浅色背景，使用深色水印
+        watermark_color = (0, 0, 0)
+        is_dark = False
+
+    # 如果背景接近灰色，则使用对比度更强的颜色
+    color_std = math.sqrt(sum((c - brightness) ** 2 for c in avg_color) / len(avg_color))
+    if color_std < 20:  # 如果颜色标准差小，说明近灰色
+        if is_dark:
+            watermark_color = (255, 255, 200)  # 淡黄色
+        else:
+            watermark_color = (0, 0, 100)      # 深蓝色
+
+    return watermark_color, is_dark
+
+
+class Stamp(NamedTuple):
+    """预渲染的水印图章"""
+    image: Image.Image          # 已旋转的 RGBA 图章
+    size: Tuple[int, int]       # 旋转前用于定位的名义尺寸
+    offset: Tuple[int, int]     # 旋转前内容相对定位原点的偏移
+    content_size: Tuple[int, int]  # 旋转前内容尺寸
+
+
+class StampCache:
+    """水印图章及文字排版缓存（LRU）：同一批次中相同参数的图章只渲染一次"""
+
+    def __init__(self, max_items=32):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        """按 key 取图章，未命中时调用 render() 生成并缓存"""
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+
+        stamp = render()
+
+        with self._lock:
+            self.misses += 1
+            self._items[key] = stamp
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return stamp
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# 进程内共享的图章缓存
+stamp_cache = StampCache()
+
+
+def _make_stamp(content, size, offset, angle):
+    """旋转图章内容（扩展到自身包围盒）"""
+    image = content
+    if angle != 0:
+        with stage("rotate"):
+            image = content.rotate(angle, expand=True, resample=Image.Resampling.BICUBIC)
+    return Stamp(image, size, offset, content.size)
+
+
+def _rotated_center(base_size, origin, offset, content_size, angle):
+    """
+    计算图章内容中心在原图中的位置
+    旋转时内容中心绕原图中心旋转，与旋转整个水印图层的效果一致
+    """
+    center_x = origin[0] + offset[0] + content_size[0] / 2
+    center_y = origin[1] + offset[1] + content_size[1] / 2
+
+    if angle != 0:
+        pivot_x, pivot_y = base_size[0] / 2, base_size[1] / 2
+        dx, dy = center_x - pivot_x, center_y - pivot_y
+        radians = math.radians(angle)
+        cos, sin = math.cos(radians), math.sin(radians)
+        # PIL 的 rotate 为逆时针旋转（y 轴向下）
+        center_x = pivot_x + dx * cos + dy * sin
+        center_y = pivot_y - dx * sin + dy * cos
+
+    return center_x, center_y
+
+
+def _stamp_position(stamp, base_size, origin, angle):
+    """计算图章左上角在原图中的位置"""
+    center_x, center_y = _rotated_center(base_size, origin, stamp.offset, stamp.content_size, angle)
+    return (int(round(center_x - stamp.image.width / 2)),
+            int(round(center_y - stamp.image.height / 2)))
+
+
+def _watermark_box(base_size, origin, offset, content_size, angle):
+    """估算水印旋转后在原图中覆盖的区域 (left, top, right, bottom)"""
+    center_x, center_y = _rotated_center(base_size, origin, offset, content_size, angle)
+    radians = math.radians(angle)
+    cos, sin = abs(math.cos(radians)), abs(math.sin(radians))
+    half_width = (content_size[0] * cos + content_size[1] * sin) / 2
+    half_height = (content_size[0] * sin + content_size[1] * cos) / 2
+    return (center_x - half_width, center_y - half_height,
+            center_x + half_width, center_y + half_height)
+
+
+def _clip_stamp_box(base_size, stamp_size, position):
+    """
+    计算图章与原图的重叠区域
+    返回 (原图中的目标位置, 图章中的源区域)，完全不重叠时返回 None
+    """
+    x, y = position
+    left, top = max(0, x), max(0, y)
+    right = min(base_size[0], x + stamp_size[0])
+    bottom = min(base_size[1], y + stamp_size[1])
+    if left >= right or top >= bottom:
+        return None
+    return (left, top), (left - x, top - y, right - x, bottom - y)
+
+
+class TilePattern(NamedTuple):
+    """平铺水印：同一个已旋转的图章按网格重复，隔行错开"""
+    stamp: Stamp
+    pitch: Tuple[int, int]      # 相邻图章左上角的水平、垂直间距
+    origin: Tuple[int, int]     # 网格中一个图章左上角在原图中的位置
+    stagger: int                # 奇数行向右错开的像素数
+    cell: Image.Image           # 两行一组的重复单元（生成图案时渲染一次，各分段共用）
+
+
+def plan_tile_pattern(stamp, size, settings):
+    """按平铺参数排列图章：网格以图片中心为基准，间距随图章大小缩放（预览与原图一致）"""
+    width, height = stamp.image.size
+    gap = max(0.0, settings.tile_spacing)
+    pitch = (max(1, int(round(width * (1 + gap)))), max(1, int(round(height * (1 + gap)))))
+    offset_x, offset_y = settings.tile_offset
+    origin = (int(round((size[0] - width) / 2 + offset_x * pitch[0])),
+              int(round((size[1] - height) / 2 + offset_y * pitch[1])))
+    stagger = int(round(settings.tile_stagger * pitch[0])) % pitch[0]
+    return TilePattern(stamp, pitch, origin, stagger, _tile_cell(stamp.image, pitch, stagger))
+
+
+def _tile_cell(image, pitch, stagger):
+    """两行一组的重复单元，第二行按 stagger 错开（超出单元的部分绕回左侧）"""
+    pitch_x, pitch_y = pitch
+    cell = Image.new("RGBA", (pitch_x, pitch_y * 2), (0, 0, 0, 0))
+    # 间距不小于图章尺寸，各次粘贴互不重叠，可以直接贴入
+    cell.paste(image, (0, 0))
+    cell.paste(image, (stagger, pitch_y))
+    if stagger + image.width > pitch_x:
+        cell.paste(image, (stagger - pitch_x, pitch_y))
+    return cell
+
+
+def _wrap_crop(image, x, y, size):
+    """从 (x, y) 截取 size 大小的区域，超出右边、下边的部分从左边、上边绕回（size 不超过 image）"""
+    region = Image.new(image.mode, size)
+    # 四次粘贴分别对应不绕回、横向绕回、纵向绕回和两者都绕回的部分，超出 region 的部分自动裁掉
+    for left in (-x, image.width - x):
+        for top in (-y, image.height - y):
+            region.paste(image, (left, top))
+    return region
+
+
+def _repeat(image, size):
+    """把 image 横向、纵向重复到 size，每次把已有部分复制一倍，只需对数次复制"""
+    width, height = size
+    while image.width < width:
+        grown = Image.new(image.mode, (min(width, image.width * 2), image.height))
+        grown.paste(image, (0, 0))
+        grown.paste(image, (image.width, 0))
+        image = grown
+    while image.height < height:
+        grown = Image.new(image.mode, (image.width, min(height, image.height * 2)))
+        grown.paste(image, (0, 0))
+        grown.paste(image, (0, image.height))
+        image = grown
+    return image.crop((0, 0, width, height)) if image.size != (width, height) else image
+
+
+def render_tile_layer(pattern, box):
+    """渲染平铺水印在 box 区域 (left, top, right, bottom) 中的 RGBA 图层"""
+    left, top, right, bottom = box
+    width, height = right - left, bottom - top
+    pitch_x, period_y = pattern.cell.size
+    # 只截取重复单元中与 box 相交的行、列（与 box 左上角对齐），再重复铺满；
+    # 分块处理时每个分段只有几十行，不必先生成整个单元高度的图层
+    cell = _wrap_crop(pattern.cell,
+                      (left - pattern.origin[0]) % pitch_x,
+                      (top - pattern.origin[1]) % period_y,
+                      (min(width, pitch_x), min(height, period_y)))
+    return _repeat(cell, (width, height))
+
+
+def _paste_source(stamp_image, mode):
+    """
+    图章转换为目标模式后的颜色和蒙版（按图章缓存，批处理中同一图章只转换一次）
+    """
+    key = (id(stamp_image), mode)
+    with _paste_sources_lock:
+        cached = _paste_sources.get(key)
+        if cached is not None and cached[0] is stamp_image:
+            _paste_sources.move_to_end(key)
+            return cached[1], cached[2]
+    color, mask = stamp_image.convert(mode), stamp_image.getchannel('A')
+    with _paste_sources_lock:
+        _paste_sources[key] = (stamp_image, color, mask)
+        while len(_paste_sources) > PASTE_SOURCE_CACHE_SIZE:
+            _paste_sources.popitem(last=False)
+    return color, mask
+
+
+# 转换后的图章：(图章 id, 模式) -> (图章, 颜色, 蒙版)；保留图章引用，id 不会被复用
+PASTE_SOURCE_CACHE_SIZE = 8
+_paste_sources = OrderedDict()
+_paste_sources_lock = Lock()
+
+
+def _composite_stamp(image, stamp, position):
+    """
+    把图章原地合成到原图，只处理图章覆盖的区域
+    RGBA 使用 alpha_composite；不含透明通道的模式以图章透明度为蒙版直接贴入；
+    16 位灰度按数值混合；调色板等其他模式只把覆盖区域转换为 RGBA 合成后再转换回去
+    """
+    tiled = isinstance(stamp, TilePattern)
+    if tiled:
+        # 平铺水印：生成恰好覆盖 image 的图层，整张图片只合成一次
+        box = (-position[0], -position[1], image.width - position[0], image.height - position[1])
+        layer = render_tile_layer(stamp, box)
+        stamp, position = Stamp(layer, layer.size, (0, 0), layer.size), (0, 0)
+
+    clipped = _clip_stamp_box(image.size, stamp.image.size, position)
+    if clipped is None:
+        return image
+    dest, source = clipped
+
+    if image.mode == "RGBA":
+        image.alpha_composite(stamp.image, dest=dest, source=source)
+        return image
+
+    whole = source == (0, 0) + stamp.image.size
+    stamp_region = stamp.image if whole else stamp.image.crop(source)
+    box = (dest[0], dest[1], dest[0] + stamp_region.width, dest[1] + stamp_region.height)
+
+    if image.mode in PASTE_MODES:
+        if whole and not tiled:
+            color, mask = _paste_source(stamp_region, image.mode)
+        else:
+            color, mask = stamp_region.convert(image.mode), stamp_region.getchannel('A')
+        image.paste(color, box, mask)
+        return image
+    if image.mode in HIGH_BIT_DEPTH_MODES:
+        # Pillow 按字节混合高位深图片，结果不正确，改用 NumPy 按数值混合
+        from watermark_blend import blend_high_bit_depth
+        image.paste(blend_high_bit_depth(image.crop(box), stamp_region), box)
+        return image
+
+    mask = stamp_region.getchannel('A')
+    region = image.crop(box).convert("RGBA")
+    region.alpha_composite(stamp_region)
+    if image.mode == "P":
+        # 映射回原调色板，只替换图章覆盖的像素（保留透明色等其余像素的索引）
+        region = region.convert("RGB").quantize(palette=image, dither=Image.Dither.NONE)
+    else:
+        region = region.convert(image.mode)
+    image.paste(region, box, mask.point(lambda value: 255 if value else 0))
+    return image
+
+
+class TextLayout(NamedTuple):
+    """多行文字排版结果"""
+    font: ImageFont.ImageFont
+    lines: list
+    line_boxes: list             # 每行的笔画范围
+    size: Tuple[int, int]        # 用于定位的名义尺寸（最大行宽, 总行高）
+    offset: Tuple[int, int]      # 笔画范围相对定位原点的偏移
+    content_size: Tuple[int, int]  # 笔画范围尺寸
+
+
+def layout_text(text, font_path, font_size):
+    """测量多行文字（逐行向下排列）"""
+    font = get_font(font_path, font_size)
+
+    draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+    # 计算每行文本的尺寸（逐行向下排列）
+    lines = text.split('\n')
+    line_boxes = []
+    total_height = 0
+    max_width = 0
+    for line in lines:
+        bbox = draw.textbbox((0, total_height), line, font=font)
+        line_boxes.append(bbox)
+        total_height += bbox[3] - bbox[1]
+        max_width = max(max_width, bbox[2] - bbox[0])
+
+    # 实际笔画范围
+    left = min(box[0] for box in line_boxes)
+    top = min(box[1] for box in line_boxes)
+    right = max(box[2] for box in line_boxes)
+    bottom = max(box[3] for box in line_boxes)
+
+    return TextLayout(font, lines, line_boxes, (max_width, total_height), (left, top),
+                      (max(1, right - left), max(1, bottom - top)))
+
+
+def render_text_stamp(text, font_path, font_size, color, alpha, angle, layout=None):
+    """渲染文字图章（可传入已测量的排版结果）"""
+    layout = layout or layout_text(text, font_path, font_size)
+    left, top = layout.offset
+
+    # 绘制每行文本
+    with stage("stamp"):
+        content = Image.new('RGBA', layout.content_size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(content)
+        current_y = 0
+        for line, box in zip(layout.lines, layout.line_boxes):
+            draw.text((-left, current_y - top), line, font=layout.font, fill=(*color, alpha))
+            current_y += box[3] - box[1]
+
+    return _make_stamp(content, layout.size, layout.offset, angle)
+
+
+def render_image_stamp(watermark_path, watermark_size, alpha, angle):
+    """渲染图片图章：缩放到 watermark_size（长边）并调整透明度"""
+    with stage("stamp"):
+        # 打开并处理水印图片
+        watermark = Image.open(watermark_path).convert("RGBA")
+
+        # 保持宽高比缩放
+        ratio = watermark_size / max(watermark.size)
+        new_size = tuple(max(1, int(dim * ratio)) for dim in watermark.size)
+        watermark = watermark.resize(new_size, Image.Resampling.LANCZOS)
+
+        # 调整透明度（查表缩放，与乘以常数图层的结果相同）
+        watermark.putalpha(watermark.getchannel('A').point(
+            [value * alpha // 255 for value in range(256)]
+        ))
+
+        # 以自身为蒙版贴到透明底上
+        content = Image.new('RGBA', watermark.size, (0, 0, 0, 0))
+        content.paste(watermark, (0, 0), watermark)
+
+    return _make_stamp(content, content.size, (0, 0), angle)
+
+
+def plan_text_watermark(size, settings, source_size=None, pick_color=None):
+    """
+    计算文字水印的图章和左上角位置，返回 (Stamp, 位置)，没有水印文字时返回 None；
+    平铺时返回 (TilePattern, (0, 0))。
+    只需要图片尺寸；智能颜色时 pick_color(box) 返回水印覆盖区域对应的水印颜色。
+    source_size 为原图尺寸：在缩小的预览代理图上渲染时，字号和边距按原图计算后等比缩放
+    """
+    # 获取水印文本
+    watermark_text = settings.text.strip()
+    if not watermark_text:
+        return None
+
+    # 计算字体大小
+    scale = size[0] / source_size[0] if source_size else 1.0
+    font_size = calculate_watermark_size(source_size or size, settings)
+    font_size = max(1, int(font_size * scale))
+
+    # 测量文字并计算位置（排版与颜色无关，单独缓存）
+    with stage("layout"):
+        layout = stamp_cache.get(
+            ("layout", watermark_text, settings.font_path, font_size),
+            lambda: layout_text(watermark_text, settings.font_path, font_size)
+        )
+    origin = calculate_position(size, layout.size, settings.position, margin=int(20 * scale))
+
+    # 设置水印颜色和透明度（智能颜色只分析水印覆盖的区域）
+    alpha = int(255 * settings.alpha)
+    tiled = settings.position == TILE_POSITION
+    if settings.auto_color and pick_color is not None:
+        if tiled:
+            box = (0, 0, size[0], size[1])
+        else:
+            box = _watermark_box(size, origin, layout.offset, layout.content_size, settings.angle)
+        with stage("analyze"):
+            watermark_color = tuple(pick_color(box))
+    else:
+        watermark_color = tuple(settings.color)
+
+    # 取缓存的图章，相同参数只渲染一次
+    key = ("text", watermark_text, settings.font_path, font_size,
+           watermark_color, alpha, settings.angle)
+    stamp = stamp_cache.get(key, lambda: render_text_stamp(
+        watermark_text, settings.font_path, font_size,
+        watermark_color, alpha, settings.angle, layout
+    ))
+    if tiled:
+        return plan_tile_pattern(stamp, size, settings), (0, 0)
+    return stamp, _stamp_position(stamp, size, origin, settings.angle)
+
+
+def plan_image_watermark(size, settings, source_size=None):
+    """计算图片水印的图章和左上角位置（参数含义同 plan_text_watermark）"""
+    if not settings.watermark_image_path:
+        return None
+
+    # 计算水印大小
+    scale = size[0] / source_size[0] if source_size else 1.0
+    base_size = min(source_size or size)
+    watermark_size = max(1, int(base_size * settings.size_ratio * scale))
+    alpha = int(255 * settings.alpha)
+
+    # 取缓存的图章（水印文件修改后自动失效）
+    path = settings.watermark_image_path
+    key = ("image", path, os.stat(path).st_mtime_ns, watermark_size, alpha, settings.angle)
+    stamp = stamp_cache.get(key, lambda: render_image_stamp(
+        path, watermark_size, alpha, settings.angle
+    ))
+    if settings.position == TILE_POSITION:
+        return plan_tile_pattern(stamp, size, settings), (0, 0)
+
+    # 居中放置
+    origin = calculate_position(size, stamp.size, "center")
+    return stamp, _stamp_position(stamp, size, origin, settings.angle)
+
+
+def plan_watermark(size, settings, source_size=None, pick_color=None):
+    """根据水印类型计算图章和位置，不需要图片像素（用于分块处理大图）"""
+    if settings.watermark_type == "text":
+        return plan_text_watermark(size, settings, source_size, pick_color)
+    return plan_image_watermark(size, settings, source_size)
+
+
+def add_text_watermark(image, settings, source_size=None):
+    """添加文字水印（source_size 含义同 plan_text_watermark，出错时抛出异常）"""
+    planned = plan_text_watermark(image.size, settings, source_size,
+                                  lambda box: analyze_background(image, box)[0])
+    if planned is not None:
+        with stage("composite"):
+            _composite_stamp(image, *planned)
+    return image
+
+
+def add_image_watermark(base_image, settings, source_size=None):
+    """添加图片水印（source_size 含义同 plan_text_watermark，出错时抛出异常）"""
+    planned = plan_image_watermark(base_image.size, settings, source_size)
+    if planned is not None:
+        with stage("composite"):
+            _composite_stamp(base_image, *planned)
+    return base_image
+
+
+def apply_watermark(image, settings, source_size=None):
+    """
+    根据水印类型为图片添加水印（保持原图模式，原地修改并返回 image）
+    出错时（如水印图片损坏）抛出异常，批处理把该文件计为失败，不写入清单
+    """
+    if settings.watermark_type == "text":
+        return add_text_watermark(image, settings, source_size)
+    return add_image_watermark(image, settings, source_size)
+
+
+def create_watermarked_image(image_path, settings):
+    """创建水印图片"""
+    try:
+        image = Image.open(image_path)
+        image.load()
+        return apply_watermark(image, settings)
+
+    except Exception as e:
+        print(f"创建水印图片时出错: {str(e)}")
+        return None
+
+
+def _encoder_options(image, output_path, settings):
+    """返回 (待保存的图片, 输出格式, 保存参数)（未给定参数快照时使用默认预设）"""
+    settings = settings or WatermarkSettings()
+    image_format, options = encoder_options(image, output_path, settings.encoder_preset,
+                                            settings.encoder_overrides, settings.keep_metadata)
+    return image_for_format(image, image_format, settings.keep_metadata), image_format, options
+
+
+def save_watermarked_image(image, output_path, settings=None):
+    """按编码预设保存水印图片（保持原图模式，JPEG 不支持时转换为 RGB）"""
+    image, image_format, options = _encoder_options(image, output_path, settings)
+    # 直接保存到文件时编码和写入无法分开计时，都记为编码
+    with stage("encode"):
+        image.save(output_path, image_format, **options)
+    count(bytes_written=os.path.getsize(output_path))
+
+
+def encode_watermarked_image(image, output_path, settings=None):
+    """把水印图片编码为字节（与 save_watermarked_image 的输出相同）"""
+    image, image_format, options = _encoder_options(image, output_path, settings)
+    buffer = io.BytesIO()
+    with stage("encode"):
+        image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def render_file(input_path, settings, data=None):
+    """
+    读取图片并添加水印，返回水印图片（出错时抛出异常）
+    data 为已读入内存的文件内容，给定时不再重复读取磁盘
+    """
+    with stage("decode"):
+        image = Image.open(io.BytesIO(data) if data is not None else input_path)
+        image.load()
+    count(pixels=image.width * image.height)
+    return apply_watermark(image, settings)
+
+
+def process_file(input_path, output_path, settings, data=None):
+    """处理单个文件：读取、添加水印并保存（出错时抛出异常）"""
+    watermarked = render_file(input_path, settings, data)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    if watermarked:
+        save_watermarked_image(watermarked, output_path, settings)
@@ -0,0 +1,122 @@
+"""
+字体查找与缓存
+
+按配置的字体、常见中文字体、系统字体目录的顺序查找可显示中文的字体，
+查找结果和按 (路径, 字号) 加载的 FreeTypeFont 对象都会缓存，批量处理时不再重复解析字体文件。
+"""
+from functools import lru_cache
+import os
+import sys
+
+from PIL import ImageFont
+
+# 通过环境变量指定字体
+FONT_ENV_VAR = "WATERMARK_FONT"
+
+# 常见中文字体（按优先级）
+FONT_CANDIDATES = (
+    # Windows
+    "C:\\Windows\\Fonts\\msyh.ttc",
+    "C:\\Windows\\Fonts\\msyh.ttf",
+    "C:\\Windows\\Fonts\\simhei.ttf",
+    "C:\\Windows\\Fonts\\simsun.ttc",
+    # macOS
+    "/System/Library/Fonts/PingFang.ttc",
+    "/System/Library/Fonts/STHeiti Medium.ttc",
+    "/System/Library/Fonts/Hiragino Sans GB.ttc",
+    "/Library/Fonts/Arial Unicode.ttf",
+    # Linux
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/adobe-source-han-sans/SourceHanSansCN-Regular.otf",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/wqy-microhei/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
+)
+
+# 扫描字体目录时，文件名包含这些关键字的视为中文字体（按优先级）
+CJK_FONT_KEYWORDS = (
+    "notosanscjk", "sourcehansans", "notoserifcjk", "sourcehanserif",
+    "msyh", "pingfang", "wqy-microhei", "wqy-zenhei", "simhei", "simsun",
+    "droidsansfallback", "uming", "ukai",
+)
+
+FONT_EXTENSIONS = ('.ttf', '.ttc', '.otf')
+
+
+def font_directories():
+    """系统字体目录（fontconfig 的默认搜索路径及各平台字体目录）"""
+    home = os.path.expanduser("~")
+    if sys.platform.startswith("win"):
+        windir = os.environ.get("WINDIR", "C:\\Windows")
+        local = os.environ.get("LOCALAPPDATA", "")
+        return [os.path.join(windir, "Fonts"),
+                os.path.join(local, "Microsoft", "Windows", "Fonts")]
+    if sys.platform == "darwin":
+        return ["/System/Library/Fonts", "/Library/Fonts",
+                os.path.join(home, "Library", "Fonts")]
+
+    data_dirs = os.environ.get("XDG_DATA_DIRS", "/usr/local/share:/usr/share").split(":")
+    data_home = os.environ.get("XDG_DATA_HOME", os.path.join(home, ".local", "share"))
+    directories = [os.path.join(data_home, "fonts"), os.path.join(home, ".fonts")]
+    directories += [os.path.join(d, "fonts") for d in data_dirs if d]
+    return directories
+
+
+def _scan_font_directories():
+    """扫描字体目录，返回优先级最高的中文字体"""
+    best, best_rank = None, len(CJK_FONT_KEYWORDS)
+    for directory in font_directories():
+        for root, _, files in os.walk(directory):
+            for name in files:
+                lower = name.lower()
+                if not lower.endswith(FONT_EXTENSIONS):
+                    continue
+                for rank, keyword in enumerate(CJK_FONT_KEYWORDS[:best_rank]):
+                    if keyword in lower:
+                        best, best_rank = os.path.join(root, name), rank
+                        break
+                if best_rank == 0:
+                    return best
+    return best
+
+
+@lru_cache(maxsize=None)
+def resolve_font_path(preferred=None):
+    """
+    返回可用的字体路径
+    依次尝试：preferred、环境变量 WATERMARK_FONT、常见中文字体、扫描系统字体目录；
+    都找不到时返回 None（使用 Pillow 内置字体）
+    """
+    for path in (preferred, os.environ.get(FONT_ENV_VAR)):
+        if path and os.path.isfile(path):
+            return path
+
+    for path in FONT_CANDIDATES:
+        if os.path.isfile(path):
+            return path
+
+    return _scan_font_directories()
+
+
+@lru_cache(maxsize=64)
+def load_font(path, size):
+    """按 (路径, 字号) 加载并缓存字体，失败时使用 Pillow 内置字体"""
+    if path:
+        try:
+            return ImageFont.truetype(path, size)
+        except Exception as e:
+            print(f"加载字体 {path} 时出错: {str(e)}")
+    try:
+        # Pillow 10.1 起内置字体支持指定字号
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def get_font(preferred, size):
+    """解析字体路径并加载指定字号的字体"""
+    return load_font(resolve_font_path(preferred), size)
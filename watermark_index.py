@@ -0,0 +1,114 @@
+"""
+输入文件夹索引
+
+一次 scandir 收集图片文件的大小和修改时间。刷新时只重新扫描修改时间发生变化的目录，
+可选递归子文件夹，输出时按相对路径镜像目录结构。
+"""
+from typing import NamedTuple
+import os
+
+from watermark_engine import SUPPORTED_FORMATS
+
+
+class IndexEntry(NamedTuple):
+    """索引中的图片文件"""
+    rel_path: str    # 相对输入文件夹的路径
+    size: int        # 文件大小（字节）
+    mtime_ns: int    # 修改时间（纳秒）
+
+
+class FolderIndex:
+    """输入文件夹索引（条目按相对路径排序）"""
+
+    def __init__(self, root, formats=SUPPORTED_FORMATS, recursive=False, exclude=()):
+        self.root = os.path.abspath(root)
+        self.formats = tuple(formats)
+        self.recursive = recursive
+        # 不扫描的目录（例如位于输入文件夹内的输出文件夹）
+        self.exclude = {os.path.normcase(os.path.abspath(path)) for path in exclude if path}
+        self.entries = []
+        self._positions = {}
+        self._dirs = {}  # 相对目录 -> (目录修改时间, [IndexEntry], [子目录])
+        self.refresh()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def path(self, entry):
+        """条目的绝对路径"""
+        return os.path.join(self.root, entry.rel_path)
+
+    def output_path(self, entry, output_root):
+        """条目在输出文件夹中的路径（镜像子目录结构）"""
+        return os.path.join(output_root, entry.rel_path)
+
+    def index_of(self, rel_path):
+        """按相对路径查找条目序号，不存在时返回 None"""
+        return self._positions.get(rel_path)
+
+    def _scan_dir(self, rel_dir):
+        """扫描单个目录，返回 (图片条目, 子目录)"""
+        files, subdirs = [], []
+        with os.scandir(os.path.join(self.root, rel_dir)) as it:
+            for item in it:
+                rel_path = os.path.join(rel_dir, item.name) if rel_dir else item.name
+                try:
+                    if item.is_dir():
+                        if os.path.normcase(item.path) not in self.exclude:
+                            subdirs.append(rel_path)
+                    elif item.is_file() and item.name.lower().endswith(self.formats):
+                        stat = item.stat()
+                        files.append(IndexEntry(rel_path, stat.st_size, stat.st_mtime_ns))
+                except OSError:
+                    continue
+        return files, subdirs
+
+    def refresh(self, force=False):
+        """
+        增量刷新索引，返回是否有变化
+        目录修改时间不变时沿用上次的扫描结果；force=True 时重新扫描所有目录，
+        用于检测原地修改（不改变目录修改时间）的文件
+        """
+        changed = False
+        seen = set()
+        pending = [""]
+
+        while pending:
+            rel_dir = pending.pop()
+            try:
+                mtime = os.stat(os.path.join(self.root, rel_dir)).st_mtime_ns
+            except OSError:
+                continue
+            seen.add(rel_dir)
+
+            cached = self._dirs.get(rel_dir)
+            if force or cached is None or cached[0] != mtime:
+                try:
+                    files, subdirs = self._scan_dir(rel_dir)
+                except OSError:
+                    continue
+                if cached is None or cached[1] != files or cached[2] != subdirs:
+                    changed = True
+                self._dirs[rel_dir] = (mtime, files, subdirs)
+
+            if self.recursive:
+                pending.extend(self._dirs[rel_dir][2])
+
+        # 移除已删除的目录
+        for rel_dir in set(self._dirs) - seen:
+            del self._dirs[rel_dir]
+            changed = True
+
+        if changed:
+            self.entries = sorted(
+                (entry for _, files, _ in self._dirs.values() for entry in files),
+                key=lambda entry: entry.rel_path
+            )
+            self._positions = {entry.rel_path: i for i, entry in enumerate(self.entries)}
+        return changed
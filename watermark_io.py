@@ -0,0 +1,57 @@
+"""
+图片读写
+
+按实际需要的分辨率解码：JPEG 使用 DCT 缩放（draft 模式）直接解码出缩小的图片，
+其他格式解码后用整数倍 reduce 快速缩小。
+"""
+import math
+
+from PIL import Image
+
+# reduce 可以直接按像素值平均缩小的模式，其他模式（调色板、1 位、各种字节序的 16 位等）缩小前先转换
+REDUCE_MODES = ("L", "LA", "La", "RGB", "RGBA", "RGBa", "RGBX", "CMYK", "YCbCr", "LAB", "HSV", "I", "F")
+
+
+def reduce_mode(mode):
+    """缩小前要转换成的模式（reduce 支持时为原模式）"""
+    if mode in REDUCE_MODES:
+        return mode
+    if mode.startswith("I;16"):
+        return "I"
+    if mode == "1":
+        return "L"
+    return "RGBA"
+
+
+def reduced_request_size(size, max_size):
+    """按比例缩放到长边为 max_size 时的尺寸（向上取整）"""
+    factor = max_size / max(size)
+    return (max(1, math.ceil(size[0] * factor)), max(1, math.ceil(size[1] * factor)))
+
+
+def open_image_reduced(path, max_size):
+    """
+    以不低于 max_size（长边）的最小分辨率解码图片
+    返回 (已加载的图片, 原图尺寸)，图片长边介于 max_size 和 2*max_size 之间（原图更小时不放大）
+    """
+    image = Image.open(path)
+    source_size = image.size
+
+    if max(source_size) <= max_size:
+        image.load()
+        return image, source_size
+
+    if image.format == "JPEG":
+        # DCT 缩放：解码时直接输出 1/2、1/4 或 1/8 尺寸
+        image.draft(image.mode, reduced_request_size(source_size, max_size))
+        image.load()
+        return image, source_size
+
+    image.load()
+    factor = int(max(source_size) // max_size)
+    if factor >= 2:
+        mode = reduce_mode(image.mode)
+        if mode != image.mode:
+            image = image.convert(mode)
+        image = image.reduce(factor)
+    return image, source_size
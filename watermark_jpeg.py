@@ -0,0 +1,173 @@
+"""
+JPEG 局部重新编码
+
+水印通常只覆盖画面的一小部分，整图解码再以固定质量重新压缩既耗时又会降低未覆盖区域的画质。
+系统中有支持 -drop 的 jpegtran（libjpeg 9 及以上或新版 libjpeg-turbo）时：
+先用 jpegtran -crop 无损裁出与水印重叠的 MCU 块，只解码这一块并合成水印，
+按原图的量化表和色度抽样重新编码，再用 jpegtran -drop 无损放回原图。
+其余 MCU 块的 DCT 系数原样复制，与原图逐位一致。
+
+不满足条件（没有 jpegtran、输出不是 JPEG、使用了非默认编码预设、需要去掉元数据、
+EXIF 方向不为正常、水印覆盖面积过大等）时返回 False，由调用方整图处理。
+"""
+import io
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+from threading import Lock
+
+from PIL import Image
+
+from watermark_encoders import DEFAULT_PRESET, EXIF_ORIENTATION
+from watermark_engine import TilePattern, _composite_stamp, contrast_color, plan_watermark, region_mean
+from watermark_timing import count, stage
+
+# 水印区域超过图片面积的该比例时整图重新编码更划算
+REGION_MAX_FRACTION = 0.5
+
+# 可以局部重新编码的扩展名
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+# Windows 下调用 jpegtran 时不弹出控制台窗口
+_CREATION_FLAGS = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+
+_jpegtran = None
+_jpegtran_checked = False
+_jpegtran_lock = Lock()
+
+
+def find_jpegtran():
+    """查找支持 -crop 和 -drop 的 jpegtran，找不到时返回 None（结果缓存）"""
+    global _jpegtran, _jpegtran_checked
+    with _jpegtran_lock:
+        if not _jpegtran_checked:
+            _jpegtran_checked = True
+            path = shutil.which("jpegtran")
+            if path:
+                try:
+                    # jpegtran -help 把用法输出到标准错误，并以非零状态退出
+                    usage = subprocess.run([path, "-help"], capture_output=True, timeout=10,
+                                           creationflags=_CREATION_FLAGS)
+                    text = (usage.stdout + usage.stderr).decode("latin-1")
+                    if "-crop" in text and "-drop" in text:
+                        _jpegtran = path
+                except (OSError, subprocess.SubprocessError):
+                    pass
+        return _jpegtran
+
+
+def _run_jpegtran(arguments, data=None):
+    """运行 jpegtran，返回标准输出；失败时抛出 OSError"""
+    result = subprocess.run([find_jpegtran()] + arguments, input=data, capture_output=True,
+                            timeout=300, creationflags=_CREATION_FLAGS)
+    if result.returncode != 0:
+        message = result.stderr.decode("utf-8", "replace").strip()
+        raise OSError(f"jpegtran 执行失败：{message}")
+    return result.stdout
+
+
+def region_encoding_applies(output_path, settings):
+    """输出设置是否允许局部重新编码（输出与原图使用相同的编码参数和元数据）"""
+    return (output_path.lower().endswith(JPEG_EXTENSIONS)
+            and settings.encoder_preset == DEFAULT_PRESET
+            and not settings.encoder_overrides
+            and settings.keep_metadata
+            and find_jpegtran() is not None)
+
+
+def _block_size(image):
+    """iMCU 尺寸：单通道为 8×8，多通道为 8×最大抽样因子"""
+    if len(image.layer) == 1:
+        return 8, 8
+    return 8 * max(layer[1] for layer in image.layer), 8 * max(layer[2] for layer in image.layer)
+
+
+def _aligned_box(box, block, size):
+    """把 box 向外扩展到 iMCU 边界（右下角不超过图片边缘）"""
+    left = max(0, int(box[0])) // block[0] * block[0]
+    top = max(0, int(box[1])) // block[1] * block[1]
+    right = min(size[0], math.ceil(box[2] / block[0]) * block[0])
+    bottom = min(size[1], math.ceil(box[3] / block[1]) * block[1])
+    return left, top, right, bottom
+
+
+def _crop(data, box):
+    """无损裁出 box（已对齐到 iMCU）区域，返回解码后的 JPEG 图片"""
+    left, top, right, bottom = box
+    cropped = _run_jpegtran(["-crop", f"{right - left}x{bottom - top}+{left}+{top}", "-copy", "none"], data)
+    image = Image.open(io.BytesIO(cropped))
+    image.load()
+    return image
+
+
+def process_jpeg_region(input_path, output_path, settings, data=None):
+    """
+    只重新编码 JPEG 中与水印重叠的 MCU 块并写入 output_path
+    返回 False 表示不适用局部重新编码（未写入任何文件），调用方应整图处理
+    """
+    if not input_path.lower().endswith(JPEG_EXTENSIONS) or not region_encoding_applies(output_path, settings):
+        return False
+    if data is None:
+        with stage("read"):
+            with open(input_path, "rb") as f:
+                data = f.read()
+        count(bytes_read=len(data))
+
+    source = Image.open(io.BytesIO(data))
+    if (source.format != "JPEG" or source.mode not in ("RGB", "L")
+            or source.getexif().get(EXIF_ORIENTATION, 1) != 1):
+        return False
+    size, block = source.size, _block_size(source)
+
+    def pick_color(box):
+        # 只解码水印覆盖的区域来分析背景颜色
+        aligned = _aligned_box(box, block, size)
+        if aligned[0] >= aligned[2] or aligned[1] >= aligned[3]:
+            return (0, 0, 0)
+        region = _crop(data, aligned)
+        inner = (max(0, int(box[0])) - aligned[0], max(0, int(box[1])) - aligned[1],
+                 min(size[0], int(box[2])) - aligned[0], min(size[1], int(box[3])) - aligned[1])
+        return contrast_color(region_mean(region, inner))[0]
+
+    try:
+        planned = plan_watermark(size, settings, pick_color=pick_color)
+        if planned is None:
+            return False
+        stamp, position = planned
+        if isinstance(stamp, TilePattern):
+            return False
+        box = _aligned_box((position[0], position[1], position[0] + stamp.image.width,
+                            position[1] + stamp.image.height), block, size)
+        area = (box[2] - box[0]) * (box[3] - box[1])
+        if area <= 0 or area > size[0] * size[1] * REGION_MAX_FRACTION:
+            return False
+
+        with stage("decode"):
+            region = _crop(data, box)
+        count(pixels=region.width * region.height)
+        with stage("composite"):
+            _composite_stamp(region, stamp, (position[0] - box[0], position[1] - box[1]))
+
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with stage("encode"):
+            # 使用原图的量化表和色度抽样，放回后与周围的块一致
+            fd, region_path = tempfile.mkstemp(suffix=".jpg", dir=os.path.dirname(output_path) or ".")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    region.save(f, "JPEG", qtables="keep", subsampling="keep")
+                result = _run_jpegtran(["-copy", "all", "-drop", f"+{box[0]}+{box[1]}", region_path], data)
+            finally:
+                os.remove(region_path)
+    except OSError as e:
+        print(f"{input_path} 无法局部重新编码（{str(e)}），改为整图处理")
+        return False
+
+    with stage("write"):
+        temp_path = output_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(result)
+        os.replace(temp_path, output_path)
+    count(bytes_written=len(result))
+    return True
@@ -0,0 +1,126 @@
+"""
+处理清单
+
+在输出文件夹中记录每个输入文件的大小、修改时间、内容哈希以及水印参数指纹。
+再次运行时跳过输出仍然有效的文件；每处理完一个文件追加一行，中断后可以继续。
+"""
+from dataclasses import asdict
+import hashlib
+import json
+import os
+
+from watermark_fonts import resolve_font_path
+
+MANIFEST_NAME = ".watermark_manifest.jsonl"
+
+
+def content_digest(data):
+    """文件内容哈希"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """分块计算文件内容哈希"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def settings_fingerprint(settings, *extra):
+    """
+    水印参数指纹
+    包含水印图片内容和实际使用的字体文件，任何一项变化都需要重新生成输出；
+    extra 用于附加其他影响输出的参数
+    """
+    data = asdict(settings)
+    if settings.watermark_type == "image" and settings.watermark_image_path:
+        data["watermark_image_digest"] = file_digest(settings.watermark_image_path)
+    if settings.watermark_type == "text":
+        font_path = resolve_font_path(settings.font_path)
+        data["font"] = font_path
+        if font_path:
+            stat = os.stat(font_path)
+            data["font_stat"] = (stat.st_size, stat.st_mtime_ns)
+    data["extra"] = [repr(item) for item in extra]
+    encoded = json.dumps(data, sort_keys=True, ensure_ascii=False, default=repr)
+    return hashlib.blake2b(encoded.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class BatchManifest:
+    """输出文件夹中的处理清单（JSON Lines 格式，后写入的记录覆盖先前的记录）"""
+
+    def __init__(self, output_folder, fingerprint):
+        self.output_folder = output_folder
+        self.fingerprint = fingerprint
+        self.path = os.path.join(output_folder, MANIFEST_NAME)
+        self.records = {}  # 相对输出路径 -> 记录
+        self._file = None
+        self.load()
+
+    def key(self, output_path):
+        """记录的键：相对输出文件夹的路径"""
+        return os.path.relpath(output_path, self.output_folder).replace(os.sep, "/")
+
+    def load(self):
+        """读取清单，忽略中断时写了一半的行"""
+        self.records = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    self.records[record["output"]] = record
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+    def check(self, output_path, size, mtime_ns):
+        """
+        检查输出是否仍然有效
+        返回 True 表示可以跳过；返回哈希字符串表示大小相同但修改时间变化，
+        需要比较内容哈希后再决定；返回 None 表示需要处理
+        """
+        record = self.records.get(self.key(output_path))
+        if not record or record.get("settings") != self.fingerprint:
+            return None
+        if not os.path.exists(output_path):
+            return None
+        if record.get("size") == size and record.get("mtime_ns") == mtime_ns:
+            return True
+        if record.get("size") == size:
+            return record.get("hash")
+        return None
+
+    def record(self, output_path, size, mtime_ns, digest):
+        """追加一条处理完成的记录（立即写入磁盘）"""
+        record = {
+            "output": self.key(output_path),
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "hash": digest,
+            "settings": self.fingerprint,
+        }
+        self.records[record["output"]] = record
+        if self._file is None:
+            os.makedirs(self.output_folder, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def compact(self):
+        """去掉被覆盖的旧记录，重写清单"""
+        self.close()
+        if not self.records:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for record in self.records.values():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
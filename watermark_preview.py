@@ -0,0 +1,210 @@
+"""
+预览加速
+
+缓存解码后缩小到画布尺寸的预览代理图，调整水印参数时只在代理图上重新渲染，
+原始分辨率只用于批量输出。预览在后台线程渲染，只保留最新的请求。
+"""
+from collections import OrderedDict, deque
+from threading import Condition, Lock, Thread
+import math
+import os
+import time
+
+from PIL import Image
+
+from watermark_engine import apply_watermark
+from watermark_io import open_image_reduced
+
+# 代理图尺寸按此步长取整，避免窗口每变化一个像素就重新解码
+PROXY_SIZE_STEP = 256
+
+
+class PreviewProxyCache:
+    """预览代理图缓存（按路径和修改时间索引，LRU 淘汰，限制总内存）"""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # key -> (代理图, 原图尺寸)
+        self._bytes = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def _image_bytes(image):
+        return image.size[0] * image.size[1] * len(image.getbands())
+
+    def get(self, path, max_size):
+        """返回 (RGBA 代理图, 原图尺寸)，代理图不超过 max_size×max_size"""
+        bound = max(PROXY_SIZE_STEP, -(-int(max_size) // PROXY_SIZE_STEP) * PROXY_SIZE_STEP)
+        key = (os.path.abspath(path), os.stat(path).st_mtime_ns, bound)
+
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        # 解码放在锁外，避免阻塞其他读取；只解码到接近画布的分辨率
+        image, source_size = open_image_reduced(path, bound)
+        proxy = image.convert("RGBA")
+        proxy.thumbnail((bound, bound), Image.Resampling.LANCZOS)
+
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = (proxy, source_size)
+                self._bytes += self._image_bytes(proxy)
+                self._evict()
+            return proxy, source_size
+
+    def _evict(self):
+        """超出内存上限时淘汰最久未使用的代理图（至少保留一张）"""
+        while self._bytes > self.max_bytes and len(self._items) > 1:
+            _, (proxy, _) = self._items.popitem(last=False)
+            self._bytes -= self._image_bytes(proxy)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+
+def create_preview_image(cache, path, settings, max_size):
+    """在缓存的代理图上渲染水印预览"""
+    proxy, source_size = cache.get(path, max_size)
+    # 复制一份，避免修改缓存中的代理图
+    try:
+        return apply_watermark(proxy.copy(), settings, source_size)
+    except Exception as e:
+        # 预览中只提示错误并显示不带水印的图片，不中断预览
+        kind = "文字" if settings.watermark_type == "text" else "图片"
+        print(f"添加{kind}水印时出错: {str(e)}")
+        return proxy.copy()
+
+
+class PreviewScheduler:
+    """
+    后台预览渲染器（最新请求优先）
+    render(request) 在工作线程中执行；连续提交时只渲染最后一次请求，
+    中间的过期请求直接丢弃。on_result(图片, 耗时秒) 在工作线程中回调，
+    由调用方切换回界面线程。
+    """
+
+    def __init__(self, render, on_result, debounce=0.03):
+        self._render = render
+        self._on_result = on_result
+        self.debounce = debounce
+        self._cond = Condition()
+        self._pending = None       # (请求, 提交时间)
+        self._closed = False
+        self._latencies = deque(maxlen=50)
+        self.dropped = 0           # 被丢弃的过期请求数
+        Thread(target=self._run, daemon=True).start()
+
+    def submit(self, request):
+        """提交渲染请求，覆盖尚未开始的旧请求"""
+        with self._cond:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = (request, time.perf_counter())
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def latency_stats(self):
+        """最近渲染耗时统计（毫秒）：last、avg、max、count"""
+        with self._cond:
+            samples = list(self._latencies)
+        if not samples:
+            return {"last": 0.0, "avg": 0.0, "max": 0.0, "count": 0}
+        return {
+            "last": samples[-1] * 1000,
+            "avg": sum(samples) / len(samples) * 1000,
+            "max": max(samples) * 1000,
+            "count": len(samples),
+        }
+
+    def _next_request(self):
+        """等待请求，并在请求停止变化 debounce 秒后取出"""
+        with self._cond:
+            while self._pending is None and not self._closed:
+                self._cond.wait()
+            # 去抖：拖动滑块时等待参数稳定
+            while not self._closed:
+                remaining = self._pending[1] + self.debounce - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._closed:
+                return None
+            pending, self._pending = self._pending, None
+            return pending
+
+    def _run(self):
+        while True:
+            pending = self._next_request()
+            if pending is None:
+                return
+            request, submitted = pending
+            try:
+                image = self._render(request)
+            except Exception as e:
+                print(f"渲染预览时出错: {str(e)}")
+                continue
+            latency = time.perf_counter() - submitted
+            with self._cond:
+                self._latencies.append(latency)
+            self._on_result(image, latency)
+
+
+class PreviewPyramid:
+    """
+    预览图的多分辨率金字塔
+    每层为上一层的一半，缩放时选取不小于目标尺寸的最小一层，只对可见区域重采样。
+    """
+
+    def __init__(self, image, min_size=64):
+        self.image = image
+        self.min_size = min_size
+        self._levels = [image]
+
+    def _level_for(self, scale):
+        """返回不小于目标缩放比例的最小一层（按需生成）"""
+        level = self._levels[0]
+        for i in range(1, 32):
+            if i >= len(self._levels):
+                previous = self._levels[-1]
+                if min(previous.size) < self.min_size * 2:
+                    break
+                self._levels.append(previous.reduce(2))
+            candidate = self._levels[i]
+            if candidate.width < self.image.width * scale:
+                break
+            level = candidate
+        return level
+
+    def render(self, scale, box):
+        """
+        按 scale 缩放后取出 box 区域
+        box 为缩放后图片坐标系中的 (x0, y0, x1, y1)
+        """
+        level = self._level_for(scale)
+        scale_x = scale * self.image.width / level.width
+        scale_y = scale * self.image.height / level.height
+        source_box = (
+            max(0.0, box[0] / scale_x), max(0.0, box[1] / scale_y),
+            min(level.width, box[2] / scale_x), min(level.height, box[3] / scale_y)
+        )
+        size = (max(1, box[2] - box[0]), max(1, box[3] - box[1]))
+
+        # 先裁出覆盖区域（外扩一个像素供插值），避免 RGBA 重采样时整幅预乘
+        crop_box = (
+            max(0, int(source_box[0]) - 1), max(0, int(source_box[1]) - 1),
+            min(level.width, int(math.ceil(source_box[2])) + 1),
+            min(level.height, int(math.ceil(source_box[3])) + 1)
+        )
+        region = level.crop(crop_box)
+        return region.resize(size, Image.Resampling.BILINEAR, box=(
+            source_box[0] - crop_box[0], source_box[1] - crop_box[1],
+            source_box[2] - crop_box[0], source_box[3] - crop_box[1]
+        ))
@@ -0,0 +1,250 @@
+"""
+缩略图缓存
+
+胶片栏使用的缩略图保存在用户缓存目录中，按文件路径、大小和修改时间索引，
+文件变化后自动失效；重新打开同一文件夹时直接读取已有缩略图，不再解码原图。
+磁盘缓存限制总大小，超出时按最近访问时间淘汰。缩略图在后台线程加载，
+只加载胶片栏当前可见的条目，先返回缓存命中的缩略图，再解码未缓存的图片。
+"""
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+import hashlib
+import os
+
+from PIL import Image
+
+from watermark_io import open_image_reduced
+
+# 缩略图长边（像素）
+THUMBNAIL_SIZE = 96
+
+# 缩略图 JPEG 质量
+THUMBNAIL_QUALITY = 85
+
+# 缓存目录名（位于用户缓存目录下）
+CACHE_DIR_NAME = os.path.join("image-watermark-tool", "thumbnails")
+
+
+def default_cache_dir():
+    """用户缓存目录中的缩略图目录（Windows 为 LOCALAPPDATA，其他系统为 XDG_CACHE_HOME 或 ~/.cache）"""
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, CACHE_DIR_NAME)
+
+
+class ThumbnailCache:
+    """
+    磁盘缩略图缓存（线程安全）
+    每张缩略图一个 JPEG 文件，文件名为 (路径, 大小, 修改时间, 缩略图尺寸) 的哈希；
+    文件修改时间记录最近访问时间，用于跨会话的 LRU 淘汰。最近使用的缩略图同时保留在内存中。
+    """
+
+    def __init__(self, folder=None, max_bytes=256 * 1024 * 1024, size=THUMBNAIL_SIZE, memory_items=512):
+        self.folder = folder or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.size = size
+        self.memory_items = memory_items
+        self._memory = OrderedDict()  # 键 -> 缩略图
+        self._files = None            # 文件名 -> 字节数（按访问时间排序，首次使用时扫描）
+        self._bytes = 0
+        self._lock = Lock()
+
+    def key(self, path, file_size, mtime_ns):
+        """缩略图的键（文件变化或缩略图尺寸变化时不同）"""
+        text = f"{os.path.abspath(path)}\0{file_size}\0{mtime_ns}\0{self.size}"
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _file_path(self, key):
+        # 按前两位分目录，避免单个目录中文件过多
+        return os.path.join(self.folder, key[:2], key + ".jpg")
+
+    def _scan(self):
+        """扫描缓存目录，按最近访问时间排序（调用方持有锁）"""
+        if self._files is not None:
+            return
+        found = []
+        try:
+            with os.scandir(self.folder) as subdirs:
+                for subdir in subdirs:
+                    if not subdir.is_dir():
+                        continue
+                    with os.scandir(subdir.path) as it:
+                        for item in it:
+                            if item.name.endswith(".jpg"):
+                                stat = item.stat()
+                                found.append((stat.st_mtime_ns, item.name[:-4], stat.st_size))
+        except OSError:
+            pass
+        found.sort()
+        self._files = OrderedDict((key, size) for _, key, size in found)
+        self._bytes = sum(self._files.values())
+        # 上次会话后大小上限可能已调小
+        self._evict()
+
+    def _remember(self, key, image):
+        """放入内存缓存（调用方持有锁）"""
+        self._memory[key] = image
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def cached(self, key):
+        """返回内存或磁盘中的缩略图，没有时返回 None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            self._scan()
+            if key not in self._files:
+                return None
+            self._files.move_to_end(key)
+
+        path = self._file_path(key)
+        try:
+            with Image.open(path) as image:
+                image.load()
+                thumbnail = image.copy()
+            # 更新访问时间，下次启动时按此排序淘汰
+            os.utime(path)
+        except OSError:
+            # 文件被删除或已损坏，按未缓存处理
+            with self._lock:
+                self._bytes -= self._files.pop(key, 0)
+            return None
+
+        with self._lock:
+            self._remember(key, thumbnail)
+        return thumbnail
+
+    def load(self, path, file_size, mtime_ns):
+        """返回缩略图，未缓存时解码原图生成并写入缓存"""
+        key = self.key(path, file_size, mtime_ns)
+        thumbnail = self.cached(key)
+        if thumbnail is not None:
+            return thumbnail
+
+        image, _ = open_image_reduced(path, self.size)
+        if image.mode != "RGB":
+            # 透明图片铺在灰色背景上，与胶片栏背景接近
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (64, 64, 64))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        image.thumbnail((self.size, self.size), Image.Resampling.LANCZOS)
+        self.store(key, image)
+        return image
+
+    def store(self, key, thumbnail):
+        """写入磁盘和内存缓存，超出大小上限时淘汰最久未访问的缩略图"""
+        path = self._file_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            thumbnail.save(temp_path, "JPEG", quality=THUMBNAIL_QUALITY)
+            os.replace(temp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            # 缓存目录不可写时只保留在内存中
+            print(f"无法写入缩略图缓存: {str(e)}")
+            with self._lock:
+                self._remember(key, thumbnail)
+            return
+
+        with self._lock:
+            self._remember(key, thumbnail)
+            self._scan()
+            self._bytes += size - self._files.get(key, 0)
+            self._files[key] = size
+            self._files.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        """超出大小上限时删除最久未访问的缩略图（调用方持有锁）"""
+        while self._bytes > self.max_bytes and len(self._files) > 1:
+            key, size = self._files.popitem(last=False)
+            self._bytes -= size
+            self._memory.pop(key, None)
+            try:
+                os.remove(self._file_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        """删除所有缓存的缩略图"""
+        with self._lock:
+            self._scan()
+            for key in self._files:
+                try:
+                    os.remove(self._file_path(key))
+                except OSError:
+                    pass
+            self._files.clear()
+            self._memory.clear()
+            self._bytes = 0
+
+
+class ThumbnailLoader:
+    """
+    后台缩略图加载器
+    request(请求) 提交当前可见的条目 [(键, 路径, 大小, 修改时间), ...]，覆盖尚未完成的旧请求；
+    工作线程先返回所有缓存命中的缩略图，再依次解码未缓存的图片，每张完成后检查是否有新请求。
+    on_result(键, 缩略图) 在工作线程中回调，由调用方切换回界面线程。
+    """
+
+    def __init__(self, cache, on_result):
+        self.cache = cache
+        self._on_result = on_result
+        self._cond = Condition()
+        self._pending = None
+        self._closed = False
+        Thread(target=self._run, daemon=True).start()
+
+    def request(self, items):
+        """提交需要加载的条目（按显示优先级排序）"""
+        with self._cond:
+            self._pending = list(items)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _next_request(self):
+        with self._cond:
+            while self._pending is None and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            items, self._pending = self._pending, None
+            return items
+
+    def _superseded(self):
+        with self._cond:
+            return self._pending is not None or self._closed
+
+    def _run(self):
+        while True:
+            items = self._next_request()
+            if items is None:
+                return
+
+            # 第一遍：缓存命中的缩略图立即返回
+            missing = []
+            for item in items:
+                thumbnail = self.cache.cached(self.cache.key(*item[1:]))
+                if thumbnail is not None:
+                    self._on_result(item[0], thumbnail)
+                else:
+                    missing.append(item)
+
+            # 第二遍：解码未缓存的图片，有新请求时放弃剩余条目
+            for item in missing:
+                if self._superseded():
+                    break
+                try:
+                    thumbnail = self.cache.load(*item[1:])
+                except Exception as e:
+                    print(f"生成缩略图时出错 {item[1]}: {str(e)}")
+                    continue
+                self._on_result(item[0], thumbnail)
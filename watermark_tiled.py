@@ -0,0 +1,517 @@
+"""
+超大 TIFF 分块处理
+
+扫描仪输出的几亿像素 TIFF 整图解码需要数 GB 内存。这里只根据图片尺寸计算水印图章，
+然后按条带（或瓦片）顺序写出新文件：与图章重叠的条带解码、合成后按原文件的压缩方式
+（LZW/Deflate/PackBits，未压缩的条带按行分段）重新编码，其余条带原样复制，
+最后写入第一页的 IFD（标签和 EXIF/GPS 子 IFD 一并复制）。输出文件紧凑，不留下旧的条带数据；
+内存占用与图片尺寸无关，只取决于单个条带和水印图章的大小。
+"""
+from typing import NamedTuple
+import io
+import os
+import struct
+
+from PIL import Image
+
+from watermark_engine import TilePattern, _composite_stamp, contrast_color, plan_watermark, region_mean
+from watermark_timing import count, stage
+
+# 超过该像素数的 TIFF 使用分块处理
+TILED_MIN_PIXELS = 50_000_000
+
+# 未压缩条带每次读写的数据量上限
+BAND_BYTES = 16 * 1024 * 1024
+
+# 单个压缩条带或瓦片解码后的大小上限，超过时整图处理
+MAX_CHUNK_BYTES = 256 * 1024 * 1024
+
+# 支持的压缩方式 -> Pillow 的压缩名称
+COMPRESSION_NAMES = {
+    1: "raw",
+    5: "tiff_lzw",
+    8: "tiff_adobe_deflate",
+    32946: "tiff_deflate",
+    32773: "packbits",
+}
+
+# TIFF 数据类型 -> 字节数
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+
+# 解码单个压缩条带时从原文件复制的标签
+CHUNK_TAGS = (258, 259, 262, 266, 277, 284, 317, 320, 338, 339)
+
+# 常用标签
+IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, COMPRESSION = 256, 257, 258, 259
+PHOTOMETRIC, FILL_ORDER, STRIP_OFFSETS, SAMPLES_PER_PIXEL = 262, 266, 273, 277
+ROWS_PER_STRIP, STRIP_BYTE_COUNTS, PLANAR_CONFIGURATION, PREDICTOR = 278, 279, 284, 317
+TILE_WIDTH, TILE_LENGTH, TILE_OFFSETS, TILE_BYTE_COUNTS = 322, 323, 324, 325
+
+# 子 IFD 指针（EXIF、GPS、互操作性），复制时一并复制指向的子 IFD
+SUB_IFD_TAGS = (34665, 34853, 40965)
+
+# 指向文件中其他数据且无法随之复制的标签（空闲块、子图像、JPEG 缩略图等），输出时去掉；
+# 与整图处理一致，输出只包含第一页
+UNCOPIED_TAGS = (288, 289, 330, 400, 513, 514)
+
+# 不保留元数据时去掉的标签：文档说明、设备、软件、时间、作者、版权、分辨率，
+# 以及 XMP、IPTC、Photoshop、ICC 配置、EXIF 和 GPS
+METADATA_TAGS = (269, 270, 271, 272, 282, 283, 285, 296, 305, 306, 315, 316,
+                 700, 33432, 33723, 34377, 34665, 34675, 34853, 37724, 50341)
+
+
+class TiledUnsupported(Exception):
+    """该文件无法分块处理（调用方应改为整图处理）"""
+
+
+class IfdEntry(NamedTuple):
+    """IFD 中的一个标签"""
+    type: int
+    count: int
+    values: tuple          # SHORT/LONG 类型的值，其他类型为 None
+    data: bytes            # 值的原始字节（文件字节序）
+
+
+def read_ifd(f, order, offset):
+    """读取 offset 处的 IFD，返回 [(标签, 类型, 数量, 值的原始字节)]"""
+    f.seek(offset)
+    count = struct.unpack(order + "H", f.read(2))[0]
+    raw = f.read(12 * count)
+    entries = []
+    for i in range(count):
+        tag, tag_type, value_count, value = struct.unpack(order + "HHL4s", raw[i * 12:(i + 1) * 12])
+        size = TYPE_SIZES.get(tag_type, 1) * value_count
+        if size > 4:
+            f.seek(struct.unpack(order + "L", value)[0])
+            value = f.read(size)
+            if len(value) != size:
+                raise TiledUnsupported("标签数据不完整")
+        entries.append((tag, tag_type, value_count, value[:size]))
+    return entries
+
+
+def read_first_ifd(f):
+    """读取第一个 IFD，返回 (字节序, {标签: IfdEntry})"""
+    header = f.read(8)
+    if header[:2] == b"II":
+        order = "<"
+    elif header[:2] == b"MM":
+        order = ">"
+    else:
+        raise TiledUnsupported("不是 TIFF 文件")
+    if struct.unpack(order + "H", header[2:4])[0] != 42:
+        raise TiledUnsupported("不支持 BigTIFF")
+
+    entries = {}
+    for tag, tag_type, value_count, data in read_ifd(f, order, struct.unpack(order + "L", header[4:8])[0]):
+        values = None
+        if tag_type in (3, 4):
+            code = "H" if tag_type == 3 else "L"
+            values = struct.unpack(order + code * value_count, data)
+        entries[tag] = IfdEntry(tag_type, value_count, values, data)
+    return order, entries
+
+
+def _align(out):
+    """补齐到偶数字节（TIFF 要求 IFD 和值按字对齐），返回当前位置"""
+    offset = out.tell()
+    if offset % 2:
+        out.write(b"\0")
+        offset += 1
+    return offset
+
+
+def write_ifd(out, order, entries):
+    """把 [(标签, 类型, 数量, 值的原始字节)] 写到 out 末尾（放不进 IFD 的值写在前面），返回 IFD 的位置"""
+    fields = []
+    for tag, tag_type, value_count, data in sorted(entries):
+        if len(data) <= 4:
+            field = data.ljust(4, b"\0")
+        else:
+            field = struct.pack(order + "L", _align(out))
+            out.write(data)
+        fields.append(struct.pack(order + "HHL", tag, tag_type, value_count) + field)
+    offset = _align(out)
+    out.write(struct.pack(order + "H", len(fields)) + b"".join(fields) + struct.pack(order + "L", 0))
+    return offset
+
+
+def copy_ifd(f, out, order, offset, depth=0):
+    """把 offset 处的子 IFD（包括其中的子 IFD）复制到 out 末尾，返回新的位置"""
+    entries = []
+    for tag, tag_type, value_count, data in read_ifd(f, order, offset):
+        if tag in SUB_IFD_TAGS:
+            if depth >= 2 or value_count != 1:
+                continue
+            pointer = struct.unpack(order + "L", data)[0]
+            data = struct.pack(order + "L", copy_ifd(f, out, order, pointer, depth + 1))
+        entries.append((tag, tag_type, value_count, data))
+    return write_ifd(out, order, entries)
+
+
+class TiffLayout:
+    """第一页图像的条带（或瓦片）布局"""
+
+    def __init__(self, f):
+        self.order, self.entries = read_first_ifd(f)
+
+        def value(tag, default=None):
+            entry = self.entries.get(tag)
+            return entry.values[0] if entry and entry.values else default
+
+        self.width = value(IMAGE_WIDTH)
+        self.height = value(IMAGE_LENGTH)
+        self.compression = value(COMPRESSION, 1)
+        self.predictor = value(PREDICTOR, 1)
+        self.photometric = value(PHOTOMETRIC)
+        self.samples = value(SAMPLES_PER_PIXEL, 1)
+        bits = self.entries.get(BITS_PER_SAMPLE)
+        self.bits = bits.values if bits and bits.values else (1,)
+
+        if self.compression not in COMPRESSION_NAMES:
+            raise TiledUnsupported(f"不支持的压缩方式 {self.compression}")
+        if value(PLANAR_CONFIGURATION, 1) != 1 and self.samples > 1:
+            raise TiledUnsupported("不支持按通道分平面存储")
+        if value(FILL_ORDER, 1) != 1:
+            raise TiledUnsupported("不支持的位序")
+        if self.compression != 1 and any(bits != 8 for bits in self.bits):
+            raise TiledUnsupported("压缩条带只支持 8 位通道")
+
+        self.tiled = TILE_OFFSETS in self.entries
+        if self.tiled:
+            self.chunk_width = value(TILE_WIDTH)
+            self.chunk_height = value(TILE_LENGTH)
+            offsets_tag, counts_tag = TILE_OFFSETS, TILE_BYTE_COUNTS
+        else:
+            self.chunk_width = self.width
+            self.chunk_height = min(value(ROWS_PER_STRIP, self.height), self.height)
+            offsets_tag, counts_tag = STRIP_OFFSETS, STRIP_BYTE_COUNTS
+        self.offsets_tag, self.counts_tag = offsets_tag, counts_tag
+        self.offsets = list(self.entries[offsets_tag].values)
+        self.byte_counts = list(self.entries[counts_tag].values)
+        if len(self.offsets) != len(self.byte_counts):
+            raise TiledUnsupported("条带偏移与字节数数量不一致")
+
+        # 每行字节数（未压缩数据按行对齐到字节）
+        self.stride = (self.chunk_width * sum(self.bits) + 7) // 8
+
+    @property
+    def chunks_across(self):
+        return -(-self.width // self.chunk_width)
+
+    def chunk_box(self, index):
+        """条带或瓦片在图片中的区域（瓦片可能超出图片边缘）"""
+        column, row = index % self.chunks_across, index // self.chunks_across
+        x, y = column * self.chunk_width, row * self.chunk_height
+        height = self.chunk_height if self.tiled else min(self.chunk_height, self.height - y)
+        return (x, y, x + self.chunk_width, y + height)
+
+    def chunks_in(self, box):
+        """与 box 相交的条带或瓦片序号"""
+        left, top, right, bottom = box
+        first_row = max(0, top // self.chunk_height)
+        last_row = min(-(-self.height // self.chunk_height), -(-bottom // self.chunk_height))
+        first_column = max(0, left // self.chunk_width)
+        last_column = min(self.chunks_across, -(-right // self.chunk_width))
+        for row in range(first_row, last_row):
+            for column in range(first_column, last_column):
+                yield row * self.chunks_across + column
+
+
+def _intersects(region, box):
+    return region[0] < box[2] and box[0] < region[2] and region[1] < box[3] and box[1] < region[3]
+
+
+class TiledTiff:
+    """按条带读取原文件，合成水印后写出新文件"""
+
+    def __init__(self, f, mode, rawmode, palette=None, keep_metadata=True):
+        self.f = f
+        self.layout = TiffLayout(f)
+        self.mode = mode
+        self.rawmode = rawmode
+        self.palette = palette
+        self.keep_metadata = keep_metadata
+
+    @property
+    def size(self):
+        return self.layout.width, self.layout.height
+
+    def bands(self, box):
+        """
+        与 box 相交的可独立读写的区域，依次产出 (区域, 条带序号, 起始行, 行数)
+        未压缩的条带按行拆分成不超过 BAND_BYTES 的分段，压缩的条带整体处理
+        """
+        layout = self.layout
+        band_rows = max(1, BAND_BYTES // max(1, layout.stride))
+        for index in layout.chunks_in(box):
+            chunk = layout.chunk_box(index)
+            if layout.compression != 1:
+                if layout.stride * (chunk[3] - chunk[1]) > MAX_CHUNK_BYTES:
+                    raise TiledUnsupported("压缩条带过大")
+                yield chunk, index, 0, chunk[3] - chunk[1]
+                continue
+            first = max(chunk[1], box[1]) - chunk[1]
+            last = min(chunk[3], box[3]) - chunk[1]
+            for start in range(first, last, band_rows):
+                rows = min(band_rows, last - start)
+                region = (chunk[0], chunk[1] + start, chunk[2], chunk[1] + start + rows)
+                yield region, index, start, rows
+
+    def read(self, index, start, rows):
+        """解码条带中从 start 行开始的 rows 行"""
+        layout = self.layout
+        width = layout.chunk_width
+        if layout.compression == 1:
+            self.f.seek(layout.offsets[index] + start * layout.stride)
+            data = self.f.read(rows * layout.stride)
+            image = Image.frombytes(self.mode, (width, rows), data, "raw", self.rawmode, layout.stride, 1)
+            if self.palette is not None:
+                image.putpalette(self.palette)
+            return image
+
+        self.f.seek(layout.offsets[index])
+        data = self.f.read(layout.byte_counts[index])
+        image = Image.open(io.BytesIO(self._chunk_tiff(width, rows, data)))
+        image.load()
+        if image.mode != self.mode:
+            raise TiledUnsupported("条带解码结果与原图模式不一致")
+        return image
+
+    def write(self, out, stamp=None, position=None, box=None):
+        """
+        按条带顺序写出完整的 TIFF：与 box 相交的条带（未压缩时为行分段）合成图章后重新编码，
+        其余条带原样复制，最后写入 IFD
+        """
+        layout = self.layout
+        order = layout.order
+        out.write((b"II" if order == "<" else b"MM") + struct.pack(order + "HL", 42, 0))
+        offsets, byte_counts = [], []
+        for index in range(len(layout.offsets)):
+            offset = _align(out)
+            for data in self._chunk_data(index, stamp, position, box):
+                with stage("write"):
+                    out.write(data)
+            offsets.append(offset)
+            byte_counts.append(out.tell() - offset)
+
+        with stage("write"):
+            ifd_offset = self._write_ifd(out, offsets, byte_counts)
+            if out.tell() >= 2 ** 32:
+                raise TiledUnsupported("文件超过 4GB")
+            out.seek(4)
+            out.write(struct.pack(order + "L", ifd_offset))
+
+    def _chunk_data(self, index, stamp, position, box):
+        """依次产出条带在输出文件中的数据"""
+        layout = self.layout
+        chunk = layout.chunk_box(index)
+        rows = chunk[3] - chunk[1]
+        if layout.compression != 1:
+            if stamp is not None and _intersects(chunk, box):
+                if layout.stride * rows > MAX_CHUNK_BYTES:
+                    raise TiledUnsupported("压缩条带过大")
+                yield self._patch(chunk, index, 0, rows, stamp, position)
+            else:
+                yield self._copy(layout.offsets[index], layout.byte_counts[index])
+            return
+
+        # 未压缩的条带按行分段，只重新编码与 box 相交的分段
+        band_rows = max(1, BAND_BYTES // max(1, layout.stride))
+        for start in range(0, rows, band_rows):
+            band = min(band_rows, rows - start)
+            region = (chunk[0], chunk[1] + start, chunk[2], chunk[1] + start + band)
+            if stamp is not None and _intersects(region, box):
+                yield self._patch(region, index, start, band, stamp, position)
+            else:
+                yield self._copy(layout.offsets[index] + start * layout.stride, band * layout.stride)
+        # 条带末尾的填充数据原样保留
+        padding = layout.byte_counts[index] - rows * layout.stride
+        if padding > 0:
+            yield self._copy(layout.offsets[index] + rows * layout.stride, padding)
+
+    def _copy(self, offset, size):
+        """读取原文件中的一段数据"""
+        with stage("read"):
+            self.f.seek(offset)
+            data = self.f.read(size)
+        if len(data) != size:
+            raise TiledUnsupported("条带数据不完整")
+        return data
+
+    def _patch(self, region, index, start, rows, stamp, position):
+        """解码一个条带分段，合成图章后重新编码"""
+        with stage("decode"):
+            image = self.read(index, start, rows)
+        with stage("composite"):
+            _composite_stamp(image, stamp, (position[0] - region[0], position[1] - region[1]))
+        with stage("encode"):
+            if self.layout.compression == 1:
+                return image.tobytes("raw", self.rawmode, self.layout.stride, 1)
+            return self._encode_chunk(image)
+
+    def _write_ifd(self, out, offsets, byte_counts):
+        """写入第一页的 IFD：条带偏移和字节数换成新值，子 IFD 一并复制（不保留元数据时去掉）"""
+        layout = self.layout
+        order = layout.order
+        entries = []
+        for tag, entry in layout.entries.items():
+            if tag in (layout.offsets_tag, layout.counts_tag) or tag in UNCOPIED_TAGS:
+                continue
+            if not self.keep_metadata and tag in METADATA_TAGS:
+                continue
+            data = entry.data
+            if tag in SUB_IFD_TAGS:
+                if entry.count != 1:
+                    continue
+                data = struct.pack(order + "L", copy_ifd(self.f, out, order, struct.unpack(order + "L", data)[0]))
+            entries.append((tag, entry.type, entry.count, data))
+        if offsets and offsets[-1] + byte_counts[-1] >= 2 ** 32:
+            raise TiledUnsupported("文件超过 4GB")
+        for tag, values in ((layout.offsets_tag, offsets), (layout.counts_tag, byte_counts)):
+            entries.append((tag, 4, len(values), struct.pack(order + "L" * len(values), *values)))
+        return write_ifd(out, order, entries)
+
+    def _chunk_tiff(self, width, height, data):
+        """把单个压缩条带包装成只含该条带的最小 TIFF，交给 Pillow 解码"""
+        order = self.layout.order
+        tags = {
+            IMAGE_WIDTH: (4, (width,)),
+            IMAGE_LENGTH: (4, (height,)),
+            ROWS_PER_STRIP: (4, (height,)),
+            STRIP_OFFSETS: (4, (0,)),
+            STRIP_BYTE_COUNTS: (4, (len(data),)),
+        }
+        for tag in CHUNK_TAGS:
+            entry = self.layout.entries.get(tag)
+            if entry is not None and entry.values is not None:
+                tags[tag] = (entry.type, entry.values)
+
+        # 文件头 + IFD + 放不进 IFD 的值 + 条带数据
+        ifd_size = 2 + 12 * len(tags) + 4
+        extra = b""
+        entries = b""
+        for tag in sorted(tags):
+            tag_type, values = tags[tag]
+            code = "H" if tag_type == 3 else "L"
+            packed = struct.pack(order + code * len(values), *values)
+            if len(packed) <= 4:
+                field = packed.ljust(4, b"\0")
+            else:
+                field = struct.pack(order + "L", 8 + ifd_size + len(extra))
+                extra += packed
+            entries += struct.pack(order + "HHL", tag, tag_type, len(values)) + field
+
+        data_offset = 8 + ifd_size + len(extra)
+        # 条带偏移写在对应的 IFD 项中
+        position = sorted(tags).index(STRIP_OFFSETS) * 12 + 8
+        entries = entries[:position] + struct.pack(order + "L", data_offset) + entries[position + 4:]
+
+        header = (b"II" if order == "<" else b"MM") + struct.pack(order + "HL", 42, 8)
+        return (header + struct.pack(order + "H", len(tags)) + entries
+                + struct.pack(order + "L", 0) + extra + data)
+
+    def _encode_chunk(self, image):
+        """按原文件的压缩方式和预测器压缩单个条带，返回条带数据"""
+        layout = self.layout
+        tiffinfo = {ROWS_PER_STRIP: image.height}
+        if layout.predictor != 1:
+            tiffinfo[PREDICTOR] = layout.predictor
+        buffer = io.BytesIO()
+        image.save(buffer, "TIFF", compression=COMPRESSION_NAMES[layout.compression], tiffinfo=tiffinfo)
+
+        # 确认编码参数与原文件一致，否则写回的数据无法按原标签解码
+        buffer.seek(0)
+        _, entries = read_first_ifd(buffer)
+
+        def value(tag, default=None):
+            entry = entries.get(tag)
+            return entry.values[0] if entry and entry.values else default
+
+        if (value(COMPRESSION, 1) != layout.compression
+                or value(PREDICTOR, 1) != layout.predictor
+                or value(PHOTOMETRIC) != layout.photometric
+                or value(SAMPLES_PER_PIXEL, 1) != layout.samples
+                or len(entries[STRIP_OFFSETS].values) != 1):
+            raise TiledUnsupported("无法按原文件的参数重新压缩条带")
+        buffer.seek(entries[STRIP_OFFSETS].values[0])
+        return buffer.read(entries[STRIP_BYTE_COUNTS].values[0])
+
+    def background_color(self, box):
+        """分块统计 box 区域的平均颜色，返回对比明显的水印颜色"""
+        left, top = max(0, int(box[0])), max(0, int(box[1]))
+        right, bottom = min(self.layout.width, int(box[2])), min(self.layout.height, int(box[3]))
+        if left >= right or top >= bottom:
+            return (0, 0, 0)
+        total, weighted = 0, None
+        for region, index, start, rows in self.bands((left, top, right, bottom)):
+            overlap = (max(left, region[0]) - region[0], max(top, region[1]) - region[1],
+                       min(right, region[2]) - region[0], min(bottom, region[3]) - region[1])
+            if overlap[0] >= overlap[2] or overlap[1] >= overlap[3]:
+                continue
+            mean = region_mean(self.read(index, start, rows), overlap)
+            area = (overlap[2] - overlap[0]) * (overlap[3] - overlap[1])
+            weighted = [w + m * area for w, m in zip(weighted or [0.0] * len(mean), mean)]
+            total += area
+        return contrast_color([w / total for w in weighted])[0]
+
+    def apply(self, settings, out):
+        """计算水印图章，把添加水印后的完整文件写入 out"""
+        planned = plan_watermark(self.size, settings, pick_color=self.background_color)
+        if planned is None:
+            self.write(out)
+            return
+        stamp, position = planned
+        if isinstance(stamp, TilePattern):
+            # 平铺水印覆盖整张图片，每个分段只生成自身区域的图层
+            box = (0, 0, self.layout.width, self.layout.height)
+        else:
+            box = (max(0, position[0]), max(0, position[1]),
+                   min(self.layout.width, position[0] + stamp.image.width),
+                   min(self.layout.height, position[1] + stamp.image.height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            self.write(out)
+            return
+        count(pixels=self.layout.width * self.layout.height)
+        self.write(out, stamp, position, box)
+
+
+def should_process_tiled(path):
+    """是否为需要分块处理的超大 TIFF（只读取文件头）"""
+    if not path.lower().endswith((".tif", ".tiff")):
+        return False
+    try:
+        with Image.open(path) as image:
+            return image.format == "TIFF" and image.width * image.height >= TILED_MIN_PIXELS
+    except Exception:
+        return False
+
+
+def process_tiled_tiff(input_path, output_path, settings):
+    """
+    分块为超大 TIFF 添加水印并写入 output_path
+    输出保留原文件的压缩方式和标签（不使用编码预设），只包含第一页；
+    settings.keep_metadata 为 False 时去掉 EXIF、GPS、ICC、XMP 等元数据标签；
+    返回 False 表示文件结构不支持分块处理，调用方应改为整图处理
+    """
+    with Image.open(input_path) as image:
+        mode = image.mode
+        rawmode = image.tile[0][3][0] if image.tile else mode
+        palette = image.getpalette() if mode == "P" else None
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    temp_path = output_path + ".tmp"
+    count(bytes_read=os.path.getsize(input_path))
+    try:
+        with open(input_path, "rb") as f, open(temp_path, "wb") as out:
+            TiledTiff(f, mode, rawmode, palette, settings.keep_metadata).apply(settings, out)
+        os.replace(temp_path, output_path)
+        count(bytes_written=os.path.getsize(output_path))
+        return True
+    except TiledUnsupported as e:
+        print(f"{input_path} 无法分块处理（{str(e)}），改为整图处理")
+        os.remove(temp_path)
+        return False
+    except Exception:
+        os.remove(temp_path)
+        raise
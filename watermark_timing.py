@@ -0,0 +1,232 @@
+"""
+分阶段计时
+
+记录每张图片在读取、解码、背景分析、文字排版、图章绘制、旋转、合成、编码和写入各阶段的耗时，
+以及像素数和读写字节数。渲染代码通过 stage() 标记阶段，只有当前线程正在记录
+（recording()）时才计时，否则几乎没有开销。子进程中的记录随渲染结果一起传回主进程。
+BatchTimings 汇总整批结果，提供实时吞吐量和剩余时间，并在结束时生成 JSON 报告。
+"""
+from contextlib import contextmanager
+from threading import Lock, local
+import heapq
+import json
+import os
+import time
+
+# 各阶段（按处理顺序）
+STAGES = ("read", "decode", "analyze", "layout", "stamp", "rotate", "composite", "encode", "write")
+
+# 报告中列出的最慢文件数
+SLOWEST_FILES = 10
+
+# 处理报告文件名（保存在输出文件夹中）
+REPORT_NAME = ".watermark_report.json"
+
+_local = local()
+
+
+class ImageTiming:
+    """单张图片的各阶段耗时（秒）和数据量"""
+
+    def __init__(self, input_path):
+        self.input_path = input_path
+        self.stages = {}
+        self.pixels = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def merge(self, other):
+        """合并另一段记录（例如子进程中的渲染阶段）"""
+        for name, seconds in other.stages.items():
+            self.add(name, seconds)
+        self.pixels += other.pixels
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+
+def current():
+    """当前线程正在记录的 ImageTiming，未记录时为 None"""
+    return getattr(_local, "record", None)
+
+
+@contextmanager
+def recording(record):
+    """在当前线程中把各阶段耗时记录到 record"""
+    previous = current()
+    _local.record = record
+    try:
+        yield record
+    finally:
+        _local.record = previous
+
+
+@contextmanager
+def stage(name):
+    """计时一个处理阶段（当前线程未记录时不计时）"""
+    record = current()
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.add(name, time.perf_counter() - start)
+
+
+def count(pixels=0, bytes_read=0, bytes_written=0):
+    """累计当前图片的像素数和读写字节数"""
+    record = current()
+    if record is not None:
+        record.pixels += pixels
+        record.bytes_read += bytes_read
+        record.bytes_written += bytes_written
+
+
+def percentile(samples, q):
+    """线性插值的分位数（samples 已排序且非空）"""
+    if len(samples) == 1:
+        return samples[0]
+    position = (len(samples) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(samples) - 1)
+    return samples[lower] + (samples[upper] - samples[lower]) * (position - lower)
+
+
+class BatchTimings:
+    """
+    整批处理的计时汇总（线程安全）
+    不保留每张图片的记录：add() 只累计总数、各阶段耗时样本和最慢文件（小顶堆），
+    进度回调中计算吞吐量和剩余时间为常数时间，几十万张的批次也不会越来越慢
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.processed = 0
+        self.pixels = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._stage_samples = {name: [] for name in STAGES}  # 阶段 -> 每张图片的耗时（秒）
+        self._slowest = []  # (总耗时, −序号, 文件摘要) 的小顶堆，最多 SLOWEST_FILES 项
+        self.skipped = 0
+        self.errors = 0
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def add(self, record):
+        total = record.total
+        with self._lock:
+            self.processed += 1
+            self.pixels += record.pixels
+            self.bytes_read += record.bytes_read
+            self.bytes_written += record.bytes_written
+            for name, seconds in record.stages.items():
+                self._stage_samples.setdefault(name, []).append(seconds)
+            if len(self._slowest) < SLOWEST_FILES or total > self._slowest[0][0]:
+                # 耗时相同时保留先完成的文件
+                entry = (total, -self.processed, {
+                    "input_path": record.input_path,
+                    "total_ms": total * 1000,
+                    "pixels": record.pixels,
+                    "stages_ms": {name: seconds * 1000 for name, seconds in record.stages.items()},
+                })
+                if len(self._slowest) < SLOWEST_FILES:
+                    heapq.heappush(self._slowest, entry)
+                else:
+                    heapq.heapreplace(self._slowest, entry)
+
+    def add_skipped(self):
+        with self._lock:
+            self.skipped += 1
+
+    def add_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def throughput(self):
+        """返回 (张/秒, 百万像素/秒)，只统计实际处理的图片"""
+        elapsed = self.elapsed
+        with self._lock:
+            images, pixels = self.processed, self.pixels
+        if not elapsed:
+            return 0.0, 0.0
+        return images / elapsed, pixels / elapsed / 1e6
+
+    def eta(self, done, total):
+        """按已完成文件的平均速度估算剩余秒数，尚无完成的文件时返回 None"""
+        if not done:
+            return None
+        return self.elapsed / done * (total - done)
+
+    def report(self):
+        """生成汇总报告：各阶段总耗时和分位数、吞吐量、读写数据量、最慢的文件"""
+        with self._lock:
+            processed, pixels = self.processed, self.pixels
+            bytes_read, bytes_written = self.bytes_read, self.bytes_written
+            stage_samples = {name: list(samples) for name, samples in self._stage_samples.items()}
+            slowest = [entry[2] for entry in sorted(self._slowest, reverse=True)]
+            skipped, errors = self.skipped, self.errors
+        elapsed = self.elapsed
+
+        stages = {}
+        for name in STAGES:
+            samples = sorted(stage_samples.get(name, ()))
+            if not samples:
+                continue
+            stages[name] = {
+                "count": len(samples),
+                "total_sec": sum(samples),
+                "mean_ms": sum(samples) / len(samples) * 1000,
+                "p50_ms": percentile(samples, 0.5) * 1000,
+                "p95_ms": percentile(samples, 0.95) * 1000,
+                "p99_ms": percentile(samples, 0.99) * 1000,
+                "max_ms": samples[-1] * 1000,
+            }
+
+        return {
+            "processed": processed,
+            "skipped": skipped,
+            "errors": errors,
+            "elapsed_sec": elapsed,
+            "images_per_sec": processed / elapsed if elapsed else 0.0,
+            "megapixels_per_sec": pixels / elapsed / 1e6 if elapsed else 0.0,
+            "pixels": pixels,
+            "bytes_read": bytes_read,
+            "bytes_written": bytes_written,
+            "stages": stages,
+            "slowest": slowest,
+        }
+
+    def save(self, output_folder):
+        """把报告写入输出文件夹，返回报告路径"""
+        path = os.path.join(output_folder, REPORT_NAME)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        return path
+
+
+def format_rate(timings, done, total):
+    """进度文字中的速度和剩余时间，例如 “3.2 张/秒，剩余约 12 秒”"""
+    images_per_sec, _ = timings.throughput()
+    if not images_per_sec:
+        return ""
+    eta = timings.eta(done, total)
+    text = f"{images_per_sec:.1f} 张/秒"
+    if eta is not None and done < total:
+        minutes, seconds = divmod(int(eta + 0.5), 60)
+        text += f"，剩余约 {minutes} 分 {seconds} 秒" if minutes else f"，剩余约 {seconds} 秒"
+    return text
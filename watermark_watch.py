@@ -0,0 +1,179 @@
+"""
+监视文件夹
+
+定时增量刷新输入文件夹索引，发现新增或修改的图片后，等待文件大小和修改时间
+保持不变（写入完成）再添加水印。处理在同一个后台线程中进行，字体和水印图章缓存
+一直保持可用，每张图片的延迟只包含解码、合成和编码。
+"""
+from threading import Event, Lock, Thread
+from typing import NamedTuple
+import os
+import time
+
+from watermark_batch import BatchTask, TaskResult, prepare_task, process_task
+from watermark_engine import SUPPORTED_FORMATS
+from watermark_index import FolderIndex
+from watermark_manifest import BatchManifest, settings_fingerprint
+
+
+class WatchEvent(NamedTuple):
+    """单个文件的处理结果"""
+    input_path: str
+    error: object       # 错误信息，成功时为 None
+    skipped: bool       # 输出仍然有效，已跳过
+    latency: float      # 从发现文件到处理完成的秒数
+
+
+def same_folder(a, b):
+    """两个路径是否指向同一文件夹（解析符号链接，按系统规则比较大小写）"""
+    return os.path.normcase(os.path.realpath(a)) == os.path.normcase(os.path.realpath(b))
+
+
+class FolderWatcher:
+    """
+    监视输入文件夹并自动添加水印
+    interval 为轮询间隔（秒）；文件大小和修改时间连续 settle 秒不变才视为写入完成；
+    目录修改时间不会因原地改写文件而变化，因此每隔 full_scan 秒完整扫描一次。
+    on_event(WatchEvent) 在监视线程中回调。
+    输出文件夹不能与输入文件夹相同（否则输出会覆盖原图并被再次当作新文件处理），此时抛出 ValueError。
+    """
+
+    def __init__(self, folder, output_folder, settings, recursive=False, interval=0.5,
+                 settle=1.0, full_scan=30.0, formats=SUPPORTED_FORMATS, on_event=None):
+        if same_folder(folder, output_folder):
+            raise ValueError("监视时输出文件夹不能与输入文件夹相同")
+        self.folder = folder
+        self.output_folder = output_folder
+        self.settings = settings
+        self.interval = interval
+        self.settle = settle
+        self.full_scan = full_scan
+        self.on_event = on_event
+        self.index = FolderIndex(folder, formats, recursive=recursive, exclude=[output_folder])
+        self.manifest = None
+        self.processed = 0
+        self.skipped = 0
+        self.errors = 0
+        # 相对路径 -> 已处理的 {(大小, 修改时间)}：包含发现时索引中的状态，
+        # 写入期间发现的文件在下次完整扫描前，索引中仍是写入中途的状态
+        self._handled = {}
+        self._pending = {}   # 相对路径 -> (大小, 修改时间, 索引中的状态, 首次发现时间, 保持不变的起始时间)
+        self._last_full_scan = 0.0
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        """在后台线程中开始监视"""
+        if self._thread is not None:
+            return
+        os.makedirs(self.output_folder, exist_ok=True)
+        self.manifest = BatchManifest(self.output_folder, settings_fingerprint(self.settings))
+        self._stop.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """停止监视（等待正在处理的文件完成）"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def stats(self):
+        """返回 (已处理, 已跳过, 失败, 等待写入完成的文件数)"""
+        with self._lock:
+            return self.processed, self.skipped, self.errors, len(self._pending)
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.poll()
+                except Exception as e:
+                    print(f"监视文件夹时出错: {str(e)}")
+                self._stop.wait(self.interval)
+        finally:
+            self.manifest.compact()
+
+    def poll(self):
+        """检查一次文件夹，处理已写入完成的图片"""
+        now = time.monotonic()
+        force = now - self._last_full_scan >= self.full_scan
+        if force:
+            self._last_full_scan = now
+        self.index.refresh(force=force)
+
+        # 找出新增或修改过的文件
+        current = set()
+        for entry in self.index:
+            current.add(entry.rel_path)
+            state = (entry.size, entry.mtime_ns)
+            if state not in self._handled.get(entry.rel_path, ()) and entry.rel_path not in self._pending:
+                self._pending[entry.rel_path] = state + (state, now, now)
+        for rel_path in set(self._pending) - current:
+            del self._pending[rel_path]
+
+        for rel_path in sorted(self._pending):
+            if self._stop.is_set():
+                break
+            if self._settled(rel_path, now):
+                self._process(rel_path)
+
+    def _settled(self, rel_path, now):
+        """文件大小和修改时间连续 settle 秒不变时视为写入完成"""
+        size, mtime_ns, indexed, found, stable_since = self._pending[rel_path]
+        try:
+            stat = os.stat(os.path.join(self.index.root, rel_path))
+        except OSError:
+            return False
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            self._pending[rel_path] = (stat.st_size, stat.st_mtime_ns, indexed, found, now)
+            return False
+        if stat.st_size == 0 or now - stable_since < self.settle:
+            return False
+        # 写入方仍占用文件时（Windows）无法打开，下次再试
+        try:
+            with open(os.path.join(self.index.root, rel_path), "rb"):
+                pass
+        except OSError:
+            return False
+        return True
+
+    def _process(self, rel_path):
+        size, mtime_ns, indexed, found, _ = self._pending.pop(rel_path)
+        task = BatchTask(
+            os.path.join(self.index.root, rel_path),
+            os.path.join(self.output_folder, rel_path),
+            size, mtime_ns
+        )
+        try:
+            task, skip = prepare_task(task, self.manifest)
+            if skip:
+                result = TaskResult(task.input_path, None, None, True)
+            else:
+                result = process_task(task, self.settings)
+        except Exception as e:
+            result = TaskResult(task.input_path, str(e), None, False)
+
+        with self._lock:
+            if result.error is not None:
+                self.errors += 1
+            elif result.skipped:
+                self.skipped += 1
+            else:
+                self.processed += 1
+        # 失败的文件同样记为已处理，内容再次变化前不重试
+        self._handled[rel_path] = {(size, mtime_ns), indexed}
+        if result.error is not None:
+            print(f"处理文件 {task.input_path} 时出错: {result.error}")
+        elif result.digest is not None:
+            self.manifest.record(task.output_path, size, mtime_ns, result.digest)
+
+        if self.on_event:
+            self.on_event(WatchEvent(task.input_path, result.error, result.skipped,
+                                     time.monotonic() - found))
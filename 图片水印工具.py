@@ -1,11 +1,23 @@
 import customtkinter as ctk
-from PIL import Image, ImageDraw, ImageFont, ImageTk, ImageChops
-import numpy as np
+from PIL import Image, ImageTk
 from threading import Thread
 import os
 from tkinter import filedialog, messagebox, Canvas
 import sys
-import math
+
+from multiprocessing import freeze_support
+
+from watermark_engine import WatermarkSettings, SUPPORTED_FORMATS, TILE_POSITION
+from watermark_encoders import DEFAULT_PRESET, ENCODER_PRESET_LABELS
+from watermark_preview import (
+    PreviewProxyCache, PreviewScheduler, PreviewPyramid, create_preview_image,
+)
+from watermark_batch import run_batch, default_workers, BatchControl, BatchProgress, BatchTask
+from watermark_index import FolderIndex
+from watermark_manifest import BatchManifest, settings_fingerprint
+from watermark_watch import FolderWatcher
+from watermark_timing import BatchTimings, format_rate
+from watermark_thumbnails import ThumbnailCache, ThumbnailLoader, THUMBNAIL_SIZE
 
 class WatermarkApp(ctk.CTk):
     def __init__(self):
@@ -57,18 +69,38 @@ class WatermarkApp(ctk.CTk):
     def _init_variables(self):
         """初始化变量"""
         self.folder_path = ""
+        self.folder_index = None
         self.output_folder = ""
         self.processing = False
         self.watermark_image_path = None
         self.current_preview = None
         self.current_preview_index = 0
-        self.supported_formats = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp')
+        self.preview_cache = PreviewProxyCache()
+        self.preview_scheduler = PreviewScheduler(self.render_preview, self.on_preview_rendered)
+        self.thumbnail_cache = ThumbnailCache()
+        self.thumbnail_loader = ThumbnailLoader(self.thumbnail_cache, self.on_thumbnail_loaded)
+        self.supported_formats = SUPPORTED_FORMATS
         
         # 创建控制变量
         self.watermark_type = ctk.StringVar(value="text")
         self.position_var = ctk.StringVar(value="center")
         self.auto_color = ctk.BooleanVar(value=True)
+        self.recursive_var = ctk.BooleanVar(value=False)
+        self.incremental_var = ctk.BooleanVar(value=True)
         self.progress_var = ctk.StringVar(value="准备就绪")
+        self.workers_var = ctk.StringVar(value=str(default_workers()))
+        self.encoder_var = ctk.StringVar(value=ENCODER_PRESET_LABELS[DEFAULT_PRESET])
+        self.keep_metadata_var = ctk.BooleanVar(value=True)
+        
+        # 批处理状态（进度按固定间隔刷新，单位毫秒）
+        self.batch_control = BatchControl()
+        self.batch_progress = BatchProgress()
+        self.batch_timings = BatchTimings()
+        self.progress_interval = 100
+        
+        # 监视文件夹（状态每 500 毫秒刷新一次）
+        self.folder_watcher = None
+        self.watch_interval = 500
 
     def _create_layout(self):
         """创建主布局"""
@@ -109,6 +141,14 @@ class WatermarkApp(ctk.CTk):
             font=self.title_font
         ).pack(side="left", padx=10)
         
+        # 预览渲染耗时
+        self.preview_latency_label = ctk.CTkLabel(
+            title_frame,
+            text="",
+            font=self.default_font
+        )
+        self.preview_latency_label.pack(side="left", padx=10)
+        
         # 添加缩放控制按钮
         zoom_frame = ctk.CTkFrame(title_frame)
         zoom_frame.pack(side="right", padx=10)
@@ -151,6 +191,34 @@ class WatermarkApp(ctk.CTk):
         self.preview_canvas.bind("<ButtonRelease-1>", self.end_move)
         self.preview_canvas.bind("<MouseWheel>", self.mouse_wheel)
         
+        # 胶片栏：只为可见的条目创建缩略图，缩略图由后台线程从磁盘缓存加载或生成
+        self.filmstrip_padding = 4
+        self.filmstrip_cell = THUMBNAIL_SIZE + 2 * self.filmstrip_padding
+        self.filmstrip_canvas = Canvas(
+            preview_frame,
+            bg='#1e1e1e',
+            highlightthickness=0,
+            height=self.filmstrip_cell,
+            xscrollincrement=self.filmstrip_cell
+        )
+        self.filmstrip_canvas.grid(row=2, column=0, sticky="ew", padx=10)
+        self.filmstrip_scrollbar = ctk.CTkScrollbar(
+            preview_frame,
+            orientation="horizontal",
+            command=self.filmstrip_canvas.xview
+        )
+        self.filmstrip_scrollbar.grid(row=3, column=0, sticky="ew", padx=10, pady=(0, 5))
+        self.filmstrip_canvas.configure(xscrollcommand=self.on_filmstrip_scrolled)
+        self.filmstrip_canvas.bind("<Configure>", lambda event: self.update_filmstrip_view())
+        self.filmstrip_canvas.bind("<Button-1>", self.on_filmstrip_click)
+        self.filmstrip_canvas.bind("<MouseWheel>", self.filmstrip_wheel)
+        
+        # 可见条目的缩略图（序号 -> PhotoImage，尚未加载时为 None），
+        # 文件夹索引变化时递增代号，丢弃旧索引的加载结果
+        self.filmstrip_photos = {}
+        self.filmstrip_generation = 0
+        self.filmstrip_requested = None
+        
         # 初始化缩放比例
         self.zoom_scale = 1.0
         self.pan_x = 0
@@ -159,6 +227,11 @@ class WatermarkApp(ctk.CTk):
         self._drag_start_y = None
         self._drag_start_pan_x = 0
         self._drag_start_pan_y = 0
+        
+        # 预览金字塔和当前已渲染的区域 (缩放比例, 区域)
+        self.preview_pyramid = None
+        self.preview_view = None
+        self._window_size = None
 
     def create_control_panel(self):
         """改进的控制面板布局"""
@@ -203,6 +276,28 @@ class WatermarkApp(ctk.CTk):
         self.output_entry.grid(row=1, column=1, padx=5, pady=2, sticky="ew")
         ctk.CTkButton(file_frame, text="选择", width=60, 
                      command=self.select_output).grid(row=1, column=2, padx=5, pady=2)
+        
+        # 是否包含子文件夹（输出时保持相同的目录结构）
+        ctk.CTkCheckBox(
+            file_frame,
+            text="包含子文件夹",
+            variable=self.recursive_var,
+            command=self.on_recursive_change
+        ).grid(row=2, column=1, padx=5, pady=2, sticky="w")
+        
+        # 增量处理：跳过输出仍然有效的图片，中断后可继续
+        ctk.CTkCheckBox(
+            file_frame,
+            text="跳过未变化的图片",
+            variable=self.incremental_var
+        ).grid(row=3, column=1, padx=5, pady=2, sticky="w")
+        
+        # 保留原图的 EXIF、ICC 配置和 DPI
+        ctk.CTkCheckBox(
+            file_frame,
+            text="保留图片元数据",
+            variable=self.keep_metadata_var
+        ).grid(row=4, column=1, padx=5, pady=2, sticky="w")
 
     def create_watermark_input(self, parent):
         """水印输入区域（文本框和图片选择）"""
@@ -284,6 +379,15 @@ class WatermarkApp(ctk.CTk):
                     value=value,
                     command=self.preview_watermark
                 ).pack(side="left", expand=True, padx=10)
+        
+        # 平铺：水印重复铺满整张图片（间距和错开比例在水印设置中调整）
+        ctk.CTkRadioButton(
+            position_frame,
+            text="平铺",
+            variable=self.position_var,
+            value=TILE_POSITION,
+            command=self.preview_watermark
+        ).pack(anchor="w", padx=10, pady=5)
 
     def create_progress_buttons(self, parent):
         """预览和操作按钮布局"""
@@ -299,6 +403,27 @@ class WatermarkApp(ctk.CTk):
         self.progress_label = ctk.CTkLabel(progress_frame, textvariable=self.progress_var)
         self.progress_label.pack(fill="x", padx=5, pady=2)
         
+        # 并行进程数
+        workers_frame = ctk.CTkFrame(progress_frame)
+        workers_frame.pack(fill="x", pady=5)
+        
+        ctk.CTkLabel(workers_frame, text="并行进程:").pack(side="left", padx=5)
+        ctk.CTkOptionMenu(
+            workers_frame,
+            variable=self.workers_var,
+            values=[str(n) for n in range(1, default_workers() + 1)],
+            width=80
+        ).pack(side="left", padx=5)
+        
+        # 输出编码预设（速度和文件大小的取舍）
+        ctk.CTkLabel(workers_frame, text="输出编码:").pack(side="left", padx=5)
+        ctk.CTkOptionMenu(
+            workers_frame,
+            variable=self.encoder_var,
+            values=list(ENCODER_PRESET_LABELS.values()),
+            width=100
+        ).pack(side="left", padx=5)
+        
         # 预览导航按钮
         nav_frame = ctk.CTkFrame(progress_frame)
         nav_frame.pack(fill="x", pady=5)
@@ -333,11 +458,40 @@ class WatermarkApp(ctk.CTk):
             command=self.preview_watermark
         ).pack(side="left", fill="x", expand=True, padx=5)
         
-        ctk.CTkButton(
+        self.start_button = ctk.CTkButton(
             button_frame,
             text="开始添加水印",
             command=self.start_watermark
-        ).pack(side="right", fill="x", expand=True, padx=5)
+        )
+        self.start_button.pack(side="right", fill="x", expand=True, padx=5)
+        
+        # 暂停和取消按钮
+        control_frame = ctk.CTkFrame(progress_frame)
+        control_frame.pack(fill="x", pady=5)
+        
+        self.pause_button = ctk.CTkButton(
+            control_frame,
+            text="暂停",
+            command=self.toggle_pause,
+            state="disabled"
+        )
+        self.pause_button.pack(side="left", fill="x", expand=True, padx=5)
+        
+        self.cancel_button = ctk.CTkButton(
+            control_frame,
+            text="取消",
+            command=self.cancel_process,
+            state="disabled"
+        )
+        self.cancel_button.pack(side="right", fill="x", expand=True, padx=5)
+        
+        # 监视文件夹：自动处理新放入输入文件夹的图片
+        self.watch_button = ctk.CTkButton(
+            progress_frame,
+            text="监视文件夹",
+            command=self.toggle_watch
+        )
+        self.watch_button.pack(fill="x", padx=5, pady=5)
 
     def create_watermark_settings(self, parent):
         """创建水印设置区域"""
@@ -363,6 +517,19 @@ class WatermarkApp(ctk.CTk):
             0, 360, 0
         )
         
+        # 平铺参数（仅在平铺位置时生效）
+        self.tile_spacing_slider = self.create_slider_with_label(
+            settings_frame, 
+            "平铺间距:", 
+            0.0, 3.0, 0.5
+        )
+        
+        self.tile_stagger_slider = self.create_slider_with_label(
+            settings_frame, 
+            "隔行错开:", 
+            0.0, 1.0, 0.5
+        )
+        
         # 创建颜色控制区域
         color_frame = ctk.CTkFrame(settings_frame)
         color_frame.pack(fill="x", pady=5)
@@ -496,89 +663,73 @@ class WatermarkApp(ctk.CTk):
             # 更新预览
             self.preview_watermark()
 
-    def analyze_background(self, image):
-        """分析图片背景颜色并返回合适的水印颜色"""
-        try:
-            # 转换图片为RGB模式进行分析
-            img_rgb = image.convert('RGB')
-            img_array = np.array(img_rgb)
-            
-            # 获取图片的高度和宽度
-            height, width = img_array.shape[:2]
-            
-            # 采样点：四个角落和中心区域
-            sample_regions = [
-                img_array[0:height//10, 0:width//10],          # 左上
-                img_array[0:height//10, -width//10:],          # 右上
-                img_array[-height//10:, 0:width//10],          # 左下
-                img_array[-height//10:, -width//10:],          # 右下
-                img_array[height//3:2*height//3, width//3:2*width//3]  # 中心区域
-            ]
-            
-            # 计算每个区域的平均颜色
-            region_colors = []
-            for region in sample_regions:
-                avg_color = np.mean(region, axis=(0,1))
-                region_colors.append(avg_color)
-            
-            # 计算整体平均颜色
-            avg_color = np.mean(region_colors, axis=0)
-            
-            # 计算亮度
-            brightness = np.mean(avg_color)
-            
-            # 根据背景亮度选择水印颜色
-            if brightness < 128:
-                # 深色背景，使用浅色水印
-                watermark_color = (255, 255, 255)
-                is_dark = True
-            else:
-                # 浅色背景，使用深色水印
-                watermark_color = (0, 0, 0)
-                is_dark = False
-            
-            # 如果背景接近灰色，则使用对比度更强的颜色
-            color_std = np.std(avg_color)
-            if color_std < 20:  # 如果颜色标准差小，说明近灰色
-                if is_dark:
-                    watermark_color = (255, 255, 200)  # 淡黄色
-                else:
-                    watermark_color = (0, 0, 100)      # 深蓝色
-            
-            return watermark_color, is_dark
-            
-        except Exception as e:
-            print(f"分析背景颜色时出错: {str(e)}")
-            # 出错时返回默认值：黑色水印
-            return (0, 0, 0), False
-        
+    def get_watermark_settings(self):
+        """在主线程读取界面控件，生成水印参数快照"""
+        return WatermarkSettings(
+            watermark_type=self.watermark_type.get(),
+            text=self.text_entry.get("1.0", "end-1c"),
+            size_ratio=float(self.size_slider.get()),
+            alpha=float(self.alpha_slider.get()),
+            angle=float(self.angle_slider.get()),
+            auto_color=bool(self.auto_color.get()),
+            color=(
+                int(self.color_r_slider.get()),
+                int(self.color_g_slider.get()),
+                int(self.color_b_slider.get())
+            ),
+            position=self.position_var.get(),
+            tile_spacing=float(self.tile_spacing_slider.get()),
+            tile_stagger=float(self.tile_stagger_slider.get()),
+            watermark_image_path=self.watermark_image_path,
+            encoder_preset=next(
+                (preset for preset, label in ENCODER_PRESET_LABELS.items()
+                 if label == self.encoder_var.get()),
+                DEFAULT_PRESET
+            ),
+            keep_metadata=bool(self.keep_metadata_var.get())
+        )
+
     def preview_watermark(self, *args):
         """预览水印效果"""
         if not self.folder_path:
             messagebox.showwarning("警告", "请先选择输入文件夹")
             return
         
-        image_files = [f for f in os.listdir(self.folder_path) 
-                       if f.lower().endswith(self.supported_formats)]
+        folder_index = self.get_folder_index()
         
-        if not image_files:
+        if not len(folder_index):
             messagebox.showwarning("警告", "输入文件夹中没有支持的图片文件")
             return
         
         # 获取当前预览图片路径
         # 更新索引显示
-        total_files = len(image_files)
+        total_files = len(folder_index)
+        self.current_preview_index = min(self.current_preview_index, total_files - 1)
         self.preview_index.configure(text=f"{self.current_preview_index + 1}/{total_files}")
+        self.select_filmstrip_item(self.current_preview_index)
 
-        current_image = os.path.join(
-            self.folder_path, 
-            image_files[self.current_preview_index]
-        )
+        current_image = folder_index.path(folder_index[self.current_preview_index])
         
-        # 创建预览图
-        watermarked = self.create_watermarked_image(current_image)
-        if watermarked:
-            self.update_preview(watermarked)
+        # 提交到后台渲染，在缓存的代理图上创建预览图
+        max_size = max(self.preview_canvas.winfo_width(), self.preview_canvas.winfo_height())
+        self.preview_scheduler.submit((current_image, self.get_watermark_settings(), max_size))
+
+    def render_preview(self, request):
+        """渲染预览图（在预览工作线程中执行，不访问控件）"""
+        image_path, settings, max_size = request
+        return create_preview_image(self.preview_cache, image_path, settings, max_size)
+
+    def on_preview_rendered(self, image, latency):
+        """预览渲染完成，切换回主线程显示"""
+        self.after(0, lambda: self.show_rendered_preview(image))
+
+    def show_rendered_preview(self, image):
+        """显示渲染好的预览图并更新渲染耗时"""
+        self.update_preview(image)
+        stats = self.preview_scheduler.latency_stats()
+        self.preview_latency_label.configure(
+            text=f"渲染 {stats['last']:.0f}ms (平均 {stats['avg']:.0f}ms)"
+        )
 
     def update_preview(self, image):
         """更新预览图片，支持缩放和平移"""
@@ -586,6 +737,12 @@ class WatermarkApp(ctk.CTk):
             return
         
         self.current_preview = image
+        self.preview_pyramid = PreviewPyramid(image)
+        self.render_preview_view()
+
+    def get_preview_geometry(self):
+        """计算预览的缩放比例、缩放后尺寸、画布上的左上角位置和画布尺寸"""
+        image = self.current_preview
         
         # 获取画布尺寸
         canvas_width = self.preview_canvas.winfo_width()
@@ -605,311 +762,342 @@ class WatermarkApp(ctk.CTk):
             int(image.height * final_scale)
         )
         
-        # 缩放图片
-        resized = image.resize(new_size, Image.Resampling.LANCZOS)
-        self.preview_photo = ImageTk.PhotoImage(resized)
+        # 计算居中位置，考虑平移偏移
+        x = (canvas_width - new_size[0]) // 2 + self.pan_x
+        y = (canvas_height - new_size[1]) // 2 + self.pan_y
+        
+        return final_scale, new_size, (x, y), (canvas_width, canvas_height)
+
+    def render_preview_view(self):
+        """只重采样画布可见区域，四周各预留半个画布供拖动"""
+        if not self.current_preview:
+            return
+        
+        scale, (width, height), (x, y), (canvas_width, canvas_height) = self.get_preview_geometry()
         
         # 清除画布
         self.preview_canvas.delete("preview_image")
+        self.preview_view = None
+        
+        # 可见区域（缩放后图片坐标）
+        margin_x, margin_y = canvas_width // 2, canvas_height // 2
+        box = (
+            max(0, -x - margin_x),
+            max(0, -y - margin_y),
+            min(width, canvas_width - x + margin_x),
+            min(height, canvas_height - y + margin_y)
+        )
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
         
-        # 计算居中位置，考虑平移偏移
-        x = (canvas_width - new_size[0]) // 2 + self.pan_x
-        y = (canvas_height - new_size[1]) // 2 + self.pan_y
+        # 从金字塔中取出可见区域
+        view = self.preview_pyramid.render(scale, box)
+        self.preview_photo = ImageTk.PhotoImage(view)
+        self.preview_view = (scale, box)
         
         # 显示图片
         self.preview_canvas.create_image(
-            x, y,
+            x + box[0], y + box[1],
             image=self.preview_photo,
             anchor="nw",
             tags="preview_image"
         )
 
-    def create_watermarked_image(self, image_path):
-        """创建水印图片"""
-        try:
-            image = Image.open(image_path).convert("RGBA")
-            
-            if self.watermark_type.get() == "text":
-                return self.add_text_watermark(image)
-            else:
-                return self.add_image_watermark(image)
-            
-        except Exception as e:
-            print(f"创建水印图片时出错: {str(e)}")
-            return None
+    def preview_view_covers_canvas(self):
+        """已渲染的区域是否仍覆盖画布上可见的部分"""
+        if not self.preview_view:
+            return False
+        
+        scale, (width, height), (x, y), (canvas_width, canvas_height) = self.get_preview_geometry()
+        rendered_scale, box = self.preview_view
+        if rendered_scale != scale:
+            return False
+        
+        visible = (max(0, -x), max(0, -y), min(width, canvas_width - x), min(height, canvas_height - y))
+        if visible[0] >= visible[2] or visible[1] >= visible[3]:
+            return True
+        return (box[0] <= visible[0] and box[1] <= visible[1]
+                and box[2] >= visible[2] and box[3] >= visible[3])
 
-    def calculate_position(self, base_size, watermark_size):
-        """计算水印位置"""
-        position = self.position_var.get()
-        x, y = 0, 0
-        
-        # 水平位置
-        if "_left" in position:
-            x = 20  # 左边距
-        elif "_right" in position:
-            x = base_size[0] - watermark_size[0] - 20  # 右边距
-        else:  # center
-            x = (base_size[0] - watermark_size[0]) // 2
-        
-        # 垂直位置
-        if position.startswith("top"):
-            y = 20  # 上边距
-        elif position.startswith("bottom"):
-            y = base_size[1] - watermark_size[1] - 20  # 下边距
-        else:  # center
-            y = (base_size[1] - watermark_size[1]) // 2
-        
-        return x, y
+    def reset_filmstrip(self, keep_position=False):
+        """文件夹索引变化时重建胶片栏（只设置滚动范围，缩略图按需创建）"""
+        self.filmstrip_generation += 1
+        self.filmstrip_photos.clear()
+        self.filmstrip_requested = None
+        canvas = self.filmstrip_canvas
+        canvas.delete("all")
+        total = len(self.folder_index) if self.folder_index is not None else 0
+        canvas.configure(scrollregion=(0, 0, total * self.filmstrip_cell, self.filmstrip_cell))
+        if not keep_position:
+            canvas.xview_moveto(0)
+        self.update_filmstrip_view()
 
-    def add_text_watermark(self, image):
-        """添加文字水印"""
-        try:
-            # 创建一个与原图相同大小的透明图层
-            watermark_layer = Image.new('RGBA', image.size, (0, 0, 0, 0))
-            draw = ImageDraw.Draw(watermark_layer)
-            
-            # 计算字体大小
-            font_size = self.calculate_watermark_size(image.size)
-            try:
-                font = ImageFont.truetype("C:\\Windows\\Fonts\\msyh.ttc", font_size)
-            except:
-                font = ImageFont.load_default()
-            
-            # 获取水印文本
-            watermark_text = self.text_entry.get("1.0", "end-1c").strip()
-            if not watermark_text:
-                return image
-            
-            # 计算文本大小和位置
-            lines = watermark_text.split('\n')
-            line_heights = []
-            total_height = 0
-            max_width = 0
-            
-            # 计算每行文本的尺寸
-            for line in lines:
-                bbox = draw.textbbox((0, 0), line, font=font)
-                line_width = bbox[2] - bbox[0]
-                line_height = bbox[3] - bbox[1]
-                line_heights.append(line_height)
-                total_height += line_height
-                max_width = max(max_width, line_width)
-            
-            # 使用新的位置计算方法
-            x, y = self.calculate_position(
-                image.size,
-                (max_width, total_height)
-            )
-            
-            # 设置水印颜色和透明度
-            alpha = int(255 * self.alpha_slider.get())
-            if self.auto_color.get():
-                watermark_color, _ = self.analyze_background(image)
-            else:
-                watermark_color = (
-                    int(self.color_r_slider.get()),
-                    int(self.color_g_slider.get()),
-                    int(self.color_b_slider.get())
+    def update_filmstrip_view(self):
+        """只保留可见范围内的缩略图，并请求加载其中尚未显示的条目"""
+        folder_index = self.folder_index
+        if folder_index is None or not len(folder_index):
+            return
+        
+        canvas = self.filmstrip_canvas
+        cell, padding = self.filmstrip_cell, self.filmstrip_padding
+        left = canvas.canvasx(0)
+        first = max(0, int(left // cell))
+        last = min(len(folder_index), int((left + canvas.winfo_width()) // cell) + 1)
+        
+        # 删除离开可见范围的条目
+        for i in [i for i in self.filmstrip_photos if not first <= i < last]:
+            del self.filmstrip_photos[i]
+            canvas.delete(f"thumb_{i}")
+        
+        # 新进入可见范围的条目先显示占位框
+        for i in range(first, last):
+            if i not in self.filmstrip_photos:
+                self.filmstrip_photos[i] = None
+                x = i * cell + padding
+                canvas.create_rectangle(
+                    x, padding, x + THUMBNAIL_SIZE, padding + THUMBNAIL_SIZE,
+                    fill=self.colors['bg'], outline="", tags=f"thumb_{i}"
                 )
-            
-            # 绘制每行文本
-            current_y = y
-            for i, line in enumerate(lines):
-                draw.text((x, current_y), line, font=font, fill=(*watermark_color, alpha))
-                current_y += line_heights[i]
-            
-            # 旋转水印
-            angle = self.angle_slider.get()
-            if angle != 0:
-                # 创建更大的画布进行旋转
-                rotate_size = (int(image.size[0] * 1.5), int(image.size[1] * 1.5))
-                rotate_layer = Image.new('RGBA', rotate_size, (0, 0, 0, 0))
-                
-                # 将水印层粘贴到旋转画布中心
-                paste_x = (rotate_size[0] - watermark_layer.size[0]) // 2
-                paste_y = (rotate_size[1] - watermark_layer.size[1]) // 2
-                rotate_layer.paste(watermark_layer, (paste_x, paste_y))
-                
-                # 旋转并裁剪回原始大小
-                rotate_layer = rotate_layer.rotate(angle, expand=False, resample=Image.Resampling.BICUBIC)
-                watermark_layer = rotate_layer.crop((
-                    (rotate_size[0] - image.size[0]) // 2,
-                    (rotate_size[1] - image.size[1]) // 2,
-                    (rotate_size[0] + image.size[0]) // 2,
-                    (rotate_size[1] + image.size[1]) // 2
-                ))
-            
-            # 合成水印
-            return Image.alpha_composite(image, watermark_layer)
-            
-        except Exception as e:
-            print(f"添加文字水印时出错: {str(e)}")
-            return image
+        canvas.tag_raise("filmstrip_selection")
+        
+        # 请求加载可见但尚未显示的缩略图（请求不变时不重复提交）
+        pending = tuple(i for i in range(first, last) if self.filmstrip_photos[i] is None)
+        if pending and pending != self.filmstrip_requested:
+            self.filmstrip_requested = pending
+            generation = self.filmstrip_generation
+            self.thumbnail_loader.request(
+                ((generation, i), folder_index.path(folder_index[i]),
+                 folder_index[i].size, folder_index[i].mtime_ns)
+                for i in pending
+            )
+
+    def on_thumbnail_loaded(self, key, thumbnail):
+        """缩略图加载完成，切换回主线程显示"""
+        self.after(0, lambda: self.show_thumbnail(key, thumbnail))
+
+    def show_thumbnail(self, key, thumbnail):
+        """在胶片栏中显示缩略图（条目已离开可见范围或索引已变化时忽略）"""
+        generation, i = key
+        if generation != self.filmstrip_generation or i not in self.filmstrip_photos:
+            return
         
-    def add_image_watermark(self, base_image):
-        """添加图片水印"""
-        try:
-            if not self.watermark_image_path:
-                return base_image
-            
-            # 打开并处理水印图片
-            watermark = Image.open(self.watermark_image_path).convert("RGBA")
-            
-            # 计算水印大小
-            base_size = min(base_image.size)
-            scale = self.size_slider.get()
-            watermark_size = int(base_size * scale)
-            
-            # 保持宽高比缩放
-            ratio = watermark_size / max(watermark.size)
-            new_size = tuple(int(dim * ratio) for dim in watermark.size)
-            watermark = watermark.resize(new_size, Image.Resampling.LANCZOS)
-            
-            # 创建透明图层
-            watermark_layer = Image.new('RGBA', base_image.size, (0, 0, 0, 0))
-            
-            # 计算居中位置
-            paste_x = (base_image.size[0] - watermark.size[0]) // 2
-            paste_y = (base_image.size[1] - watermark.size[1]) // 2
-            
-            # 调整透明度
-            alpha = int(255 * self.alpha_slider.get())
-            watermark.putalpha(ImageChops.multiply(
-                watermark.getchannel('A'),
-                Image.new('L', watermark.size, alpha)
-            ))
-            
-            # 粘贴水印
-            watermark_layer.paste(watermark, (paste_x, paste_y), watermark)
-            
-            # 旋转水印
-            angle = self.angle_slider.get()
-            if angle != 0:
-                # 创建更大的画布进行旋转
-                rotate_size = [int(s * 1.5) for s in base_image.size]
-                rotate_layer = Image.new('RGBA', rotate_size, (0, 0, 0, 0))
-                
-                # 将水印层粘贴到旋转画布中心
-                paste_x = (rotate_size[0] - watermark_layer.size[0]) // 2
-                paste_y = (rotate_size[1] - watermark_layer.size[1]) // 2
-                rotate_layer.paste(watermark_layer, (paste_x, paste_y))
-                
-                # 旋转并裁剪
-                rotate_layer = rotate_layer.rotate(angle, expand=False, resample=Image.Resampling.BICUBIC)
-                watermark_layer = rotate_layer.crop((
-                    (rotate_size[0] - base_image.size[0]) // 2,
-                    (rotate_size[1] - base_image.size[1]) // 2,
-                    (rotate_size[0] + base_image.size[0]) // 2,
-                    (rotate_size[1] + base_image.size[1]) // 2
-                ))
-            
-            # 合成最终图片
-            return Image.alpha_composite(base_image, watermark_layer)
-            
-        except Exception as e:
-            print(f"添加图片水印时出错: {str(e)}")
-            return base_image
+        photo = ImageTk.PhotoImage(thumbnail)
+        self.filmstrip_photos[i] = photo
+        canvas = self.filmstrip_canvas
+        canvas.delete(f"thumb_{i}")
+        canvas.create_image(
+            i * self.filmstrip_cell + self.filmstrip_cell // 2, self.filmstrip_cell // 2,
+            image=photo,
+            tags=f"thumb_{i}"
+        )
+        canvas.tag_raise("filmstrip_selection")
+
+    def select_filmstrip_item(self, index):
+        """高亮当前预览的图片，不在可见范围内时滚动到该位置"""
+        canvas = self.filmstrip_canvas
+        cell = self.filmstrip_cell
+        x = index * cell
+        canvas.delete("filmstrip_selection")
+        canvas.create_rectangle(
+            x + 1, 1, x + cell - 1, cell - 1,
+            outline=self.colors['accent'], width=2, tags="filmstrip_selection"
+        )
         
-    def process_images(self):
-        """处理所有图片（线程安全，UI更新用after）"""
+        left = canvas.canvasx(0)
+        width = canvas.winfo_width()
+        if x < left or x + cell > left + width:
+            total_width = len(self.folder_index) * cell
+            canvas.xview_moveto(max(0, x + cell / 2 - width / 2) / total_width)
+
+    def on_filmstrip_scrolled(self, first, last):
+        """胶片栏滚动后同步滚动条并更新可见条目"""
+        self.filmstrip_scrollbar.set(first, last)
+        self.update_filmstrip_view()
+
+    def on_filmstrip_click(self, event):
+        """点击缩略图切换预览"""
+        if self.folder_index is None:
+            return
+        index = int(self.filmstrip_canvas.canvasx(event.x) // self.filmstrip_cell)
+        if 0 <= index < len(self.folder_index):
+            self.current_preview_index = index
+            self.preview_watermark()
+
+    def filmstrip_wheel(self, event):
+        """鼠标滚轮横向滚动胶片栏"""
+        self.filmstrip_canvas.xview_scroll(-1 if event.delta > 0 else 1, "units")
+
+    def process_images(self, tasks, settings, workers, control, progress, incremental=True, timings=None):
+        """
+        处理所有图片（在后台线程运行，进度写入 progress，由界面定时读取）
+        timings（BatchTimings）记录各阶段耗时，结束后保存到输出文件夹
+        """
+        result = None
+        manifest = None
         try:
-            folder = self.folder_path
             output_folder = self.output_folder
             
             # 创建输出文件夹
             if not os.path.exists(output_folder):
                 os.makedirs(output_folder)
             
-            # 获取所有支持的图片文件
-            image_files = [f for f in os.listdir(folder) if f.lower().endswith(self.supported_formats)]
-            total_files = len(image_files)
+            # 增量处理：根据输出文件夹中的处理清单跳过未变化的图片
+            if incremental:
+                manifest = BatchManifest(output_folder, settings_fingerprint(settings))
             
-            if total_files == 0:
-                self.after(0, lambda: messagebox.showinfo("提示", "没有找到支持的图片文件"))
-                self.after(0, lambda: self.set_processing_state(False, "准备就绪", 0))
-                return
+            progress.update(0, len(tasks))
+            timings = timings or BatchTimings()
             
-            for i, filename in enumerate(image_files, 1):
-                try:
-                    input_path = os.path.join(folder, filename)
-                    output_path = os.path.join(output_folder, filename)  # 保持原文件名
-                    
-                    # UI更新用after
-                    self.after(0, lambda i=i, total_files=total_files: self.set_processing_state(True, f"处理中... ({i}/{total_files})", i/total_files))
-                    
-                    # 处理图片
-                    image = Image.open(input_path).convert("RGBA")
-                    watermarked = None
-                    
-                    if self.watermark_type.get() == "text":
-                        watermarked = self.add_text_watermark(image)
-                    else:
-                        watermarked = self.add_image_watermark(image)
-                    
-                    if watermarked:
-                        # 保存时转换回RGB模式
-                        if output_path.lower().endswith('.jpg') or output_path.lower().endswith('.jpeg'):
-                            watermarked = watermarked.convert('RGB')
-                        watermarked.save(output_path, quality=95)
-                    
-                except Exception as e:
-                    self.after(0, lambda filename=filename, e=e: messagebox.showerror("错误", f"处理文件 {filename} 时出错：{str(e)}"))
-                    continue
+            def on_error(input_path, error):
+                print(f"处理文件 {input_path} 时出错: {error}")
+                progress.add_error(os.path.basename(input_path), error)
             
-            self.after(0, lambda: self.set_processing_state(False, "处理完成！", 1))
-            self.after(0, lambda: messagebox.showinfo("完成", f"所有图片处理完成！\n输出目录：{output_folder}"))
+            # 使用进程池并行处理
+            result = run_batch(
+                tasks, settings, workers,
+                on_progress=lambda done, total, _: progress.update(done, total),
+                on_error=on_error,
+                control=control,
+                manifest=manifest,
+                timings=timings
+            )
+            
+            # 每次运行结束都在输出文件夹中保存各阶段耗时报告
+            timings.save(output_folder)
             
         except Exception as e:
-            self.after(0, lambda e=e: messagebox.showerror("错误", f"处理过程出错：{str(e)}"))
-            self.after(0, lambda: self.set_processing_state(False, "准备就绪", 0))
+            progress.add_error(self.folder_path, f"处理过程出错：{str(e)}")
         finally:
-            self.after(0, lambda: self.set_processing_state(False, "准备就绪", 0))
+            progress.finish(result)
 
     def set_processing_state(self, processing, progress_text, progress_value):
-        """线程安全地设置进度条和状态"""
+        """设置进度条和状态（仅在主线程调用）"""
         self.processing = processing
         self.progress_var.set(progress_text)
         self.progress_bar.set(progress_value)
 
-    def start_process(self):
-        """开始处理图片"""
-        if self.processing:
-            return
+    def poll_progress(self):
+        """按固定频率刷新进度，合并工作线程的进度更新"""
+        done, total, errors, finished = self.batch_progress.snapshot()
         
-        if not self.folder_path or not self.output_folder:
-            messagebox.showerror("错误", "请选择输入和输出文件夹")
+        if finished:
+            self.on_batch_finished()
             return
         
-        if self.watermark_type.get() == "text" and not self.text_entry.get("1.0", "end-1c").strip():
-            messagebox.showerror("错误", "请输入水印文本")
+        status = "已暂停" if self.batch_control.paused else "处理中..."
+        text = f"{status} ({done}/{total})"
+        rate = format_rate(self.batch_timings, done, total)
+        if rate:
+            text += f" {rate}"
+        if errors:
+            text += f" 失败 {errors}"
+        self.set_processing_state(True, text, done / total if total else 0)
+        self.after(self.progress_interval, self.poll_progress)
+
+    def on_batch_finished(self):
+        """批处理结束：恢复按钮并汇报结果"""
+        done, total, _, _ = self.batch_progress.snapshot()
+        errors = self.batch_progress.errors
+        cancelled = self.batch_control.cancelled
+        
+        self.pause_button.configure(text="暂停", state="disabled")
+        self.cancel_button.configure(state="disabled")
+        self.start_button.configure(state="normal")
+        self.watch_button.configure(state="normal")
+        
+        if cancelled:
+            self.set_processing_state(False, f"已取消 ({done}/{total})", done / total if total else 0)
+        else:
+            self.set_processing_state(False, "处理完成！", 1)
+        
+        if errors:
+            # 只列出前几个失败的文件，避免弹窗过长
+            details = "\n".join(f"{name}：{error}" for name, error in errors[:10])
+            if len(errors) > 10:
+                details += f"\n... 共 {len(errors)} 个文件失败"
+            messagebox.showerror("错误", f"以下文件处理失败：\n{details}")
+        elif not cancelled:
+            result = self.batch_progress.result
+            skipped = f"\n跳过未变化的图片：{result.skipped} 张" if result and result.skipped else ""
+            messagebox.showinfo("完成", f"所有图片处理完成！{skipped}\n输出目录：{self.output_folder}")
+
+    def toggle_pause(self):
+        """暂停或继续批处理"""
+        if not self.processing:
             return
-        
-        if self.watermark_type.get() == "image" and not self.watermark_image_path:
-            messagebox.showerror("错误", "请选择水印图片")
+        if self.batch_control.paused:
+            self.batch_control.resume()
+            self.pause_button.configure(text="暂停")
+        else:
+            self.batch_control.pause()
+            self.pause_button.configure(text="继续")
+
+    def cancel_process(self):
+        """取消批处理"""
+        if self.processing:
+            self.batch_control.cancel()
+            self.pause_button.configure(state="disabled")
+            self.cancel_button.configure(state="disabled")
+            self.progress_var.set("正在取消...")
+
+    def toggle_watch(self):
+        """开始或停止监视输入文件夹"""
+        if self.folder_watcher is not None:
+            self.stop_watch()
+            return
+        if self.processing or not self.validate_inputs():
             return
         
-        self.processing = True
-        Thread(target=self.process_images).start()
+        # 使用开始监视时的水印参数，修改参数后需重新开始监视
+        try:
+            self.folder_watcher = FolderWatcher(
+                self.folder_path,
+                self.output_folder,
+                self.get_watermark_settings(),
+                recursive=bool(self.recursive_var.get())
+            )
+        except ValueError as e:
+            messagebox.showerror("错误", str(e))
+            return
+        self.folder_watcher.start()
+        self.watch_button.configure(text="停止监视")
+        self.start_button.configure(state="disabled")
+        self.set_processing_state(True, "监视中...", 0)
+        self.after(self.watch_interval, self.poll_watch)
 
-    # 加一个新的方法来计算标准化的水印尺寸
-    def calculate_watermark_size(self, image_size):
-        """
-        计算水印的标准化尺寸
-        基于图片对角线长度计算，确保水印大小在视觉上保持一致
-        """
-        # 计算图片对角线长度
-        diagonal = math.sqrt(image_size[0]**2 + image_size[1]**2)
-        # 基于对角线长度计算基准字体大小
-        base_size = diagonal * self.size_slider.get()
-        # 设置最小和最大限制
-        min_size = 24  # 最小字体大小
-        max_size = diagonal * 0.2  # 最大不超过对角线的20%
-        return int(max(min_size, min(base_size, max_size)))
+    def stop_watch(self):
+        """停止监视（后台线程处理完当前图片后退出）"""
+        watcher, self.folder_watcher = self.folder_watcher, None
+        Thread(target=watcher.stop, daemon=True).start()
+        self.watch_button.configure(text="监视文件夹")
+        self.start_button.configure(state="normal")
+        processed, skipped, errors, _ = watcher.stats()
+        self.set_processing_state(False, f"已停止监视（处理 {processed} 张，失败 {errors} 张）", 0)
+
+    def poll_watch(self):
+        """刷新监视状态"""
+        watcher = self.folder_watcher
+        if watcher is None:
+            return
+        processed, skipped, errors, pending = watcher.stats()
+        text = f"监视中... 已处理 {processed} 张"
+        if pending:
+            text += f"，等待写入 {pending} 张"
+        if errors:
+            text += f"，失败 {errors} 张"
+        self.progress_var.set(text)
+        self.after(self.watch_interval, self.poll_watch)
 
     def on_window_resize(self, event=None):
         """窗口大小改变时更新预览"""
-        if hasattr(self, 'current_preview') and self.current_preview:
-            self.update_preview(self.current_preview)
+        # <Configure> 会被所有子控件触发，只处理主窗口尺寸的实际变化
+        if event is not None and (event.widget is not self
+                                  or (event.width, event.height) == self._window_size):
+            return
+        if event is not None:
+            self._window_size = (event.width, event.height)
+        if self.current_preview:
+            self.render_preview_view()
 
     def select_input(self):
         """选择输入文件夹"""
@@ -928,6 +1116,9 @@ class WatermarkApp(ctk.CTk):
             # 如果文件夹不存在，创建它
             if not os.path.exists(output_folder):
                 os.makedirs(output_folder)
+            
+            # 扫描文件夹并显示胶片栏（缩略图在后台加载）
+            self.get_folder_index()
 
     def select_output(self):
         """选择输出文件夹"""
@@ -973,19 +1164,41 @@ class WatermarkApp(ctk.CTk):
         slider.set(default)
         return slider
 
+    def get_folder_index(self, refresh=False):
+        """获取输入文件夹索引（文件夹或递归选项变化时重建，refresh 时增量刷新）"""
+        recursive = bool(self.recursive_var.get())
+        index = self.folder_index
+        if index is None or index.root != os.path.abspath(self.folder_path) or index.recursive != recursive:
+            self.folder_index = FolderIndex(
+                self.folder_path,
+                self.supported_formats,
+                recursive=recursive,
+                exclude=[self.output_folder]
+            )
+            self.current_preview_index = 0
+            self.reset_filmstrip()
+        elif refresh and index.refresh():
+            self.reset_filmstrip(keep_position=True)
+        return self.folder_index
+
+    def on_recursive_change(self):
+        """切换是否包含子文件夹"""
+        if self.folder_path:
+            self.get_folder_index()
+            self.preview_watermark()
+
     def change_preview(self, direction):
         """切换预览图片"""
         if not self.folder_path:
             return
         
-        image_files = [f for f in os.listdir(self.folder_path) 
-                       if f.lower().endswith(self.supported_formats)]
+        folder_index = self.get_folder_index(refresh=True)
         
-        if not image_files:
+        if not len(folder_index):
             return
         
         # 计算新的索引
-        total = len(image_files)
+        total = len(folder_index)
         new_index = (self.current_preview_index + direction) % total
         self.current_preview_index = new_index
         
@@ -1024,15 +1237,15 @@ class WatermarkApp(ctk.CTk):
         self.zoom_scale *= factor
         # 限制缩放范围
         self.zoom_scale = max(0.1, min(5.0, self.zoom_scale))
-        self.update_preview(self.current_preview)
+        self.render_preview_view()
 
     def reset_preview(self):
         """重置预览状态"""
         self.zoom_scale = 1.0
         self.pan_x = 0
         self.pan_y = 0
-        if hasattr(self, 'current_preview'):
-            self.update_preview(self.current_preview)
+        if self.current_preview:
+            self.render_preview_view()
 
     def start_move(self, event):
         """开始移动预览图片"""
@@ -1046,10 +1259,18 @@ class WatermarkApp(ctk.CTk):
         if self._drag_start_x is not None and self._drag_start_y is not None:
             dx = event.x - self._drag_start_x
             dy = event.y - self._drag_start_y
-            self.pan_x = self._drag_start_pan_x + dx
-            self.pan_y = self._drag_start_pan_y + dy
-            if hasattr(self, 'current_preview') and self.current_preview:
-                self.update_preview(self.current_preview)
+            pan_x = self._drag_start_pan_x + dx
+            pan_y = self._drag_start_pan_y + dy
+            move_x, move_y = pan_x - self.pan_x, pan_y - self.pan_y
+            self.pan_x, self.pan_y = pan_x, pan_y
+            if not self.current_preview:
+                return
+            
+            # 已渲染区域足够时只移动画布元素，不重新采样
+            if self.preview_view_covers_canvas():
+                self.preview_canvas.move("preview_image", move_x, move_y)
+            else:
+                self.render_preview_view()
 
     def end_move(self, event):
         """结束拖动，清理临时变量"""
@@ -1063,50 +1284,61 @@ class WatermarkApp(ctk.CTk):
         else:
             self.zoom_preview(0.9)
 
-    def start_watermark(self):
-        """开始添加水印"""
+    def validate_inputs(self):
+        """检查文件夹和水印设置，不完整时提示并返回 False"""
         if not self.folder_path or not self.output_folder:
             messagebox.showwarning("警告", "请先选择输入和输出文件夹")
+            return False
+        
+        if self.watermark_type.get() == "text" and not self.text_entry.get("1.0", "end-1c").strip():
+            messagebox.showerror("错误", "请输入水印文本")
+            return False
+        
+        if self.watermark_type.get() == "image" and not self.watermark_image_path:
+            messagebox.showerror("错误", "请选择水印图片")
+            return False
+        return True
+
+    def start_watermark(self):
+        """开始添加水印（后台处理，不阻塞界面）"""
+        if self.processing or not self.validate_inputs():
             return
         
-        # 获取所有支持的图片文件
-        image_files = [f for f in os.listdir(self.folder_path) 
-                       if f.lower().endswith(self.supported_formats)]
+        # 获取所有支持的图片文件（完整扫描一次，发现原地修改的文件）
+        folder_index = self.get_folder_index()
+        folder_index.refresh(force=True)
         
-        if not image_files:
+        if not len(folder_index):
             messagebox.showwarning("警告", "输入文件夹中没有支持的图片文件")
             return
         
-        try:
-            # 开始处理
-            self.processing = True
-            total = len(image_files)
-            
-            for i, filename in enumerate(image_files, 1):
-                # 更新进度
-                self.progress_var.set(f"处理中... {i}/{total}")
-                self.update_idletasks()
-                
-                # 处理单个图片
-                input_path = os.path.join(self.folder_path, filename)
-                output_path = os.path.join(self.output_folder, filename)
-                
-                # 创建水印图片
-                watermarked = self.create_watermarked_image(input_path)
-                if watermarked:
-                    # 保存图片
-                    watermarked.save(output_path, quality=95)
-            
-            # 完成处理
-            self.processing = False
-            self.progress_var.set("处理完成")
-            messagebox.showinfo("完成", f"已处理 {total} 张图片")
-            
-        except Exception as e:
-            self.processing = False
-            self.progress_var.set("处理出错")
-            messagebox.showerror("错误", f"处理图片时出错：{str(e)}")
+        # 保持原文件名，子文件夹按相同结构输出
+        tasks = [BatchTask(folder_index.path(entry), folder_index.output_path(entry, self.output_folder),
+                           entry.size, entry.mtime_ns)
+                 for entry in folder_index]
+        
+        # 在主线程生成参数快照，后台线程不再访问控件
+        self.batch_control = BatchControl()
+        self.batch_progress = BatchProgress(len(tasks))
+        self.batch_timings = BatchTimings()
+        workers = int(self.workers_var.get())
+        
+        self.start_button.configure(state="disabled")
+        self.watch_button.configure(state="disabled")
+        self.pause_button.configure(text="暂停", state="normal")
+        self.cancel_button.configure(state="normal")
+        self.set_processing_state(True, f"处理中... (0/{len(tasks)})", 0)
+        
+        Thread(
+            target=self.process_images,
+            args=(tasks, self.get_watermark_settings(), workers, self.batch_control, self.batch_progress,
+                  bool(self.incremental_var.get()), self.batch_timings),
+            daemon=True
+        ).start()
+        self.after(self.progress_interval, self.poll_progress)
 
 if __name__ == "__main__":
+    # 打包为可执行文件时多进程需要
+    freeze_support()
     app = WatermarkApp()
     app.mainloop()